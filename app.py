@@ -1,9 +1,6 @@
 __author__ = "Jeremy Nelson"
 
-import os
-
 from flask import Flask
-from werkzeug.contrib.cache import FileSystemCache
 from aristotle.blueprint import aristotle
 
 app = Flask(__name__,  instance_relative_config=True, template_folder="templates")
@@ -16,14 +13,3 @@ app.register_blueprint(aristotle)
 #for row in app.jinja_loader.list_templates():
 #    if row in aristotle_templates:
 #        aristotle_templates.pop(row)
-
-        
-
-cache = FileSystemCache(
-    app.config.get(
-        "CACHE_DIR", 
-        os.path.join(
-            os.path.split(
-                os.path.abspath(os.path.curdir))[0],
-                "cache")))
-
@@ -4,17 +4,39 @@ __author__ = "Jeremy Nelson"
 
 import os
 import requests
+import tempfile
 import urllib.parse
 from bs4 import BeautifulSoup
 from flask import Flask, url_for, current_app
-from werkzeug.contrib.cache import FileSystemCache
 try:
-    from .search import REPO_SEARCH
+    from .search import CONF, REPO_SEARCH
+    from .search.cache import LRUCache, create_cache
+    from .search.singleflight import SingleFlight
 except ImportError or ValueError:
-    from search import REPO_SEARCH
+    from search import CONF, REPO_SEARCH
+    from search.cache import LRUCache, create_cache
+    from search.singleflight import SingleFlight
 
-cache = FileSystemCache(
+# Shared cache for browse results, search results, thumbnails and site
+# chrome, configured by the CACHE_* settings in the instance conf
+cache = create_cache(
+    CONF,
     os.path.join(
         os.path.split(
             os.path.abspath(os.path.curdir))[0],
                 "cache"))
+
+# Coalesces recomputation of expired or missing cache entries so one
+# thread per uwsgi worker and one worker per host runs each search
+SINGLE_FLIGHT = SingleFlight(
+    getattr(CONF,
+            "SINGLEFLIGHT_DIR",
+            os.path.join(tempfile.gettempdir(), "digitalcc-locks")),
+    wait=getattr(CONF, "SINGLEFLIGHT_WAIT", 10.0))
+
+# In-process thumbnail tier in front of the on-disk cache, entries are
+# (content, mimetype, etag) tuples and content is None for missing thumbnails
+THUMBNAIL_CACHE = LRUCache(
+    max_entries=4096,
+    max_bytes=32 * 1024 * 1024,
+    sizeof=lambda entry: len(entry[0] or b"") + 128)
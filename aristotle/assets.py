@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Module builds fingerprinted, precompressed copies of the static assets
+and resolves their names for templates.
+
+Run with python3 aristotle/assets.py, the build writes static/dist with
+content-hashed filenames, gzip and, if the brotli package is installed,
+brotli variants of the compressible files and a manifest.json of original
+to fingerprinted names. The build is deterministic so every image built
+from the same commit has the same names.
+"""
+__author__ = "Jeremy Nelson"
+
+import click
+import gzip
+import hashlib
+import io
+import json
+import os
+import posixpath
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+DIST = "dist"
+MANIFEST_PATH = os.path.join(STATIC_DIR, DIST, "manifest.json")
+# Extensions worth precompressing, images and woff fonts are compressed
+COMPRESSIBLE = {".css", ".eot", ".js", ".json", ".otf", ".svg", ".ttf", ".txt"}
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+__manifest__ = {"mtime": None, "files": dict()}
+
+def fingerprint(path, content):
+    """Function returns path with the first 10 characters of the sha1 of
+    content inserted before the extension
+
+    Args:
+        path -- Relative path of the asset
+        content -- Bytes of the asset
+    """
+    root, extension = os.path.splitext(path)
+    return "{}.{}{}".format(
+        root, hashlib.sha1(content).hexdigest()[:10], extension)
+
+def rewrite_css(path, content, manifest):
+    """Function rewrites relative url() references in a stylesheet to the
+    fingerprinted names, keeping any query string or fragment
+
+    Args:
+        path -- Relative path of the stylesheet
+        content -- Bytes of the stylesheet
+        manifest -- dict of relative path to fingerprinted path
+    """
+    directory = posixpath.dirname(path)
+
+    def replace(match):
+        quote, url = match.groups()
+        if re.match(r"^([a-z]+:|/|#)", url):
+            return match.group(0)
+        target, suffix = re.match(r"^([^?#]*)(.*)$", url).groups()
+        resolved = posixpath.normpath(posixpath.join(directory, target))
+        if not resolved in manifest:
+            return match.group(0)
+        new_url = posixpath.relpath(manifest[resolved], directory) + suffix
+        return "url({0}{1}{0})".format(quote, new_url)
+
+    return CSS_URL.sub(replace, content.decode("utf-8")).encode("utf-8")
+
+def compress(content):
+    """Function returns a dictionary of the gzip and, if available, brotli
+    encodings of content, gzip uses a fixed mtime so builds are repeatable
+
+    Args:
+        content -- Bytes
+    """
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode="wb", compresslevel=9,
+                       mtime=0) as gzip_file:
+        gzip_file.write(content)
+    encoded = {".gz": output.getvalue()}
+    if brotli is not None:
+        encoded[".br"] = brotli.compress(content)
+    return encoded
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fo:
+        fo.write(content)
+
+def build_assets(static_dir=STATIC_DIR):
+    """Function builds static_dir/dist from the files in static_dir, the
+    stylesheets are built last so their url() references can be rewritten
+    to the fingerprinted names first
+
+    Args:
+        static_dir -- Static folder
+
+    Returns:
+        The manifest dictionary
+    """
+    dist_dir = os.path.join(static_dir, DIST)
+    paths = []
+    for root, directories, filenames in os.walk(static_dir):
+        if os.path.abspath(root) == os.path.abspath(dist_dir):
+            directories[:] = []
+            continue
+        directories[:] = [row for row in directories
+                          if os.path.join(root, row) != dist_dir]
+        for filename in filenames:
+            paths.append(os.path.relpath(
+                os.path.join(root, filename), static_dir).replace(os.sep, "/"))
+    paths.sort(key=lambda path: (path.endswith(".css"), path))
+    manifest = dict()
+    for path in paths:
+        with open(os.path.join(static_dir, path), "rb") as fo:
+            content = fo.read()
+        if path.endswith(".css"):
+            content = rewrite_css(path, content, manifest)
+        manifest[path] = fingerprint(path, content)
+        output_path = os.path.join(dist_dir, manifest[path])
+        write_file(output_path, content)
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            for extension, encoded in compress(content).items():
+                if len(encoded) < len(content):
+                    write_file(output_path + extension, encoded)
+    write_file(os.path.join(dist_dir, "manifest.json"),
+               json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+def get_manifest():
+    """Function returns the build manifest, reloading it when the file
+    changes and returning an empty dictionary if assets were not built"""
+    try:
+        mtime = os.path.getmtime(MANIFEST_PATH)
+    except OSError:
+        return dict()
+    if mtime != __manifest__["mtime"]:
+        with open(MANIFEST_PATH) as fo:
+            __manifest__["files"] = json.load(fo)
+        __manifest__["mtime"] = mtime
+    return __manifest__["files"]
+
+def asset_path(filename):
+    """Function returns the static filename to link for filename, the
+    fingerprinted dist copy if it was built
+
+    Args:
+        filename -- Path relative to the static folder
+    """
+    fingerprinted = get_manifest().get(filename)
+    if fingerprinted is None:
+        return filename
+    return "{}/{}".format(DIST, fingerprinted)
+
+@click.command()
+def build():
+    """Builds fingerprinted and precompressed static assets"""
+    manifest = build_assets()
+    print("Built {} assets in {}".format(
+        len(manifest), os.path.join(STATIC_DIR, DIST)))
+
+if __name__ == "__main__":
+    build()
@@ -0,0 +1,151 @@
+"""Module harvests the library homepage's tabs, scripts and styles for the
+site chrome. A background thread re-scrapes on a schedule, renders are
+always served the last good copy and a fallback file lets a cold start
+render without waiting on the library's site."""
+__author__ = "Jeremy Nelson"
+
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+from bs4 import BeautifulSoup
+
+try:
+    from .search import BASE_DIR, CONF
+except (ImportError, ValueError):
+    from search import BASE_DIR, CONF
+
+CHROME_URL = getattr(
+    CONF,
+    "CHROME_URL",
+    "https://www.coloradocollege.edu/library/")
+# Seconds between scrapes, seconds before retrying a failed scrape and
+# CSS selector of the homepage's tabs
+CHROME_REFRESH = getattr(CONF, "CHROME_REFRESH", 3600)
+CHROME_RETRY = getattr(CONF, "CHROME_RETRY", 300)
+CHROME_TABS_SELECTOR = getattr(CONF, "CHROME_TABS_SELECTOR", "nav")
+# Last good copy shared by the uwsgi workers and used on a cold start
+CHROME_FALLBACK = getattr(
+    CONF,
+    "CHROME_FALLBACK",
+    os.path.join(BASE_DIR, "instance", "chrome.json"))
+
+CHROME = dict()
+__refresher__ = {"pid": None}
+__refresher_lock__ = threading.Lock()
+
+def harvest(url=None, timeout=(3.05, 10)):
+    """Function scrapes the library homepage and returns a dictionary of
+    the tabs, scripts and styles HTML with absolute URLs
+
+    Args:
+        url -- Library homepage URL, defaults to CHROME_URL
+        timeout -- Connect and read timeout in seconds
+    """
+    url = url or CHROME_URL
+    result = requests.get(url, timeout=timeout)
+    result.raise_for_status()
+    soup = BeautifulSoup(result.text, "html.parser")
+    for tag, attribute in [("a", "href"),
+                           ("img", "src"),
+                           ("link", "href"),
+                           ("script", "src")]:
+        for element in soup.find_all(tag):
+            if element.get(attribute):
+                element[attribute] = urllib.parse.urljoin(
+                    url, element[attribute])
+    tabs = soup.select(CHROME_TABS_SELECTOR)
+    return {
+        "tabs": str(tabs[0]) if len(tabs) > 0 else "",
+        "scripts": "\n".join(str(script)
+                             for script in soup.find_all("script", src=True)),
+        "styles": "\n".join(str(link) for link in soup.find_all(
+            "link", rel="stylesheet"))
+    }
+
+def load_fallback():
+    """Function returns the persisted chrome and its age in seconds, or
+    (None, None) if there is no fallback file"""
+    try:
+        with open(CHROME_FALLBACK) as fo:
+            chrome = json.load(fo)
+        return chrome, time.time() - os.path.getmtime(CHROME_FALLBACK)
+    except (OSError, ValueError):
+        return None, None
+
+def save_fallback(chrome):
+    """Function atomically replaces the persisted chrome
+
+    Args:
+        chrome -- Dictionary from harvest
+    """
+    tmp_path = "{}.{}.tmp".format(CHROME_FALLBACK, os.getpid())
+    with open(tmp_path, "w") as fo:
+        json.dump(chrome, fo)
+    os.replace(tmp_path, CHROME_FALLBACK)
+
+def refresh_chrome():
+    """Function updates CHROME from the fallback file if another worker
+    refreshed it within CHROME_REFRESH seconds, otherwise harvests the
+    homepage. A failed harvest keeps the last good copy.
+
+    Returns:
+        Seconds until the next refresh
+    """
+    chrome, age = load_fallback()
+    if chrome is not None and age < CHROME_REFRESH:
+        CHROME.update(chrome)
+        return CHROME_REFRESH - age
+    try:
+        chrome = harvest()
+    except (requests.exceptions.RequestException, ValueError) as error:
+        print("Failed to harvest {}: {}".format(CHROME_URL, error))
+        return min(CHROME_REFRESH, CHROME_RETRY)
+    CHROME.update(chrome)
+    try:
+        save_fallback(chrome)
+    except OSError as error:
+        print("Failed to save {}: {}".format(CHROME_FALLBACK, error))
+    return CHROME_REFRESH
+
+def start_refresher():
+    """Function starts the background refresh thread once per process,
+    it is started on first use so each forked uwsgi worker has its own"""
+    if __refresher__["pid"] == os.getpid():
+        return
+    with __refresher_lock__:
+        if __refresher__["pid"] == os.getpid():
+            return
+        __refresher__["pid"] = os.getpid()
+
+        def refresh_loop():
+            while 1:
+                try:
+                    delay = refresh_chrome()
+                except Exception as error:
+                    # Keeps the thread alive, renders use the last copy
+                    print("Failed to refresh chrome: {}".format(error))
+                    delay = CHROME_RETRY
+                time.sleep(delay)
+
+        threading.Thread(target=refresh_loop,
+                         name="chrome-refresher",
+                         daemon=True).start()
+
+def get_chrome(name):
+    """Function returns the tabs, scripts or styles HTML without blocking on
+    the library homepage, an empty string until the first copy is
+    available
+
+    Args:
+        name -- tabs, scripts or styles
+    """
+    start_refresher()
+    if len(CHROME) < 1:
+        chrome, age = load_fallback()
+        if chrome is not None:
+            CHROME.update(chrome)
+    return CHROME.get(name, "")
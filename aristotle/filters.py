@@ -2,7 +2,9 @@ __author__ = "Jeremy Nelson"
 
 import re
 from flask import url_for
+from .assets import asset_path
 from .blueprint import aristotle
+from .chrome import get_chrome
 import search
 
 
@@ -34,13 +36,26 @@ def get_icon(datastream):
     if mime_type.endswith("tif"):
         return "glyphicon-download"
 
+@aristotle.app_template_global('static_url_for')
+def static_url_for(endpoint, **values):
+    """Global calls url_for with static filenames replaced by their
+    fingerprinted build names, templates override url_for with it
+
+    Args:
+        endpoint -- Flask endpoint
+    """
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = asset_path(values['filename'])
+    return url_for(endpoint, **values)
+
 @aristotle.app_template_filter('scripts')
 def get_scripts(s):
-    scripts = cache.get('scripts')
-    if scripts:
-        return scripts
-    harvest()
-    return cache.get('scripts')
+    """Filter returns CC Library's homepage scripts from the last harvest
+
+    Args:
+        s -- Ignored string to call from template
+    """
+    return get_chrome('scripts')
 
 @aristotle.app_template_filter('slugify')
 def slugify(value):
@@ -54,29 +69,29 @@ def slugify(value):
 
 @aristotle.app_template_filter('styles')
 def get_styles(s):
-    styles = cache.get('styles')
-    if styles:
-        return styles
-    harvest()
-    return cache.get('styles')
+    """Filter returns CC Library's homepage styles from the last harvest
+
+    Args:
+        s -- Ignored string to call from template
+    """
+    return get_chrome('styles')
 
 @aristotle.app_template_filter('tabs')
 def get_tabs(s):
-    """Filter retrieves or harvests CC Library's homepage tabs
+    """Filter returns CC Library's homepage tabs from the last harvest,
+    which is refreshed in the background by aristotle.chrome
   
     Args:
         s -- Ignored string to call from template
     """
-    tabs = cache.get('tabs')
-    if tabs:
-        return tabs
-    harvest()
-    return cache.get('tabs')
+    return get_chrome('tabs')
 
 
 @aristotle.app_template_filter('title_principal')
 def get_title(pid):
-    """Filter takes a pid and attempts to return the titlePrincipal
+    """Filter takes a pid and attempts to return the titlePrincipal, views
+    should call search.get_titles with the page's pids before rendering so
+    this filter is served from search.TITLE_CACHE
 
     Args:
         pid -- Fedora Object PID
@@ -1,17 +1,26 @@
 """
- :mod:`help_loader` Loads help rst files for use in the discovery layer
+ :mod:`help_loader` Loads help rst files for use in the discovery layer.
+
+ Help pages are compiled to HTML ahead of time with
+ python3 -m aristotle.help.help_loader, or lazily on first use, into the
+ compiled directory keyed by each rst file's content hash. Importing this
+ module does no docutils work.
 """
 __author__ = "Gautam Webb"
 
-from docutils.core import publish_string
-from BeautifulSoup import BeautifulSoup
-import os,sys
+import click
+import hashlib
+import os
+import threading
+
+from collections.abc import Mapping
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
-help_loader = dict()
+COMPILED_DIR = os.path.join(CURRENT_DIR, "compiled")
 
-fixures_walker = os.walk(CURRENT_DIR)
-fixures_listing = next(fixures_walker)[2]
+# In-process cache of help page name to ((mtime, size), html)
+__compiled__ = dict()
+__compiled_lock__ = threading.Lock()
 
 def get_file(filename,fixures_dir=CURRENT_DIR):
     """
@@ -24,12 +33,109 @@ def get_file(filename,fixures_dir=CURRENT_DIR):
     file_obj.close()
     return file_contents
 
-for filename in fixures_listing:
-    root,extension = os.path.splitext(filename)
-    if extension == '.rst':
-        raw_contents = get_file(filename,CURRENT_DIR)
-        rst_contents = publish_string(raw_contents,
-                                      writer_name="html")
-        rst_soup = BeautifulSoup(rst_contents)
-        main_contents = rst_soup.find("div",attrs={"class":"document"})
-        help_loader[root] = main_contents.prettify()
+def help_names(fixures_dir=CURRENT_DIR):
+    """
+    Helper function returns the names of the help rst files
+
+    :param fixures_dir: Directory of the rst files
+    """
+    return sorted(os.path.splitext(filename)[0]
+                  for filename in os.listdir(fixures_dir)
+                  if filename.endswith(".rst"))
+
+def compile_rst(raw_contents):
+    """
+    Function renders rst with docutils and returns the prettified HTML of
+    the document div, docutils is only imported when a page is compiled
+
+    :param raw_contents: rst as bytes
+    """
+    from docutils.core import publish_string
+    from bs4 import BeautifulSoup
+    rst_contents = publish_string(raw_contents,
+                                  writer_name="html")
+    rst_soup = BeautifulSoup(rst_contents, "html.parser")
+    main_contents = rst_soup.find("div",attrs={"class":"document"})
+    return main_contents.prettify()
+
+def compiled_path(name, digest):
+    """
+    Helper function returns the path of a compiled help page
+
+    :param name: Help page name
+    :param digest: sha1 hex digest of the rst contents
+    """
+    return os.path.join(COMPILED_DIR, "{}-{}.html".format(name, digest))
+
+def get_help(name, fixures_dir=CURRENT_DIR):
+    """
+    Function returns the HTML for a help page or None if there is no rst
+    file for name. An unchanged mtime and size returns the in-process copy,
+    otherwise the rst is hashed and the compiled file for that hash is read
+    or, if missing, compiled and written.
+
+    :param name: Help page name, the rst filename without extension
+    """
+    rst_path = os.path.join(fixures_dir, "{}.rst".format(name))
+    try:
+        stat = os.stat(rst_path)
+    except OSError:
+        return
+    version = (stat.st_mtime_ns, stat.st_size)
+    entry = __compiled__.get(name)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    with __compiled_lock__:
+        raw_contents = get_file(rst_path, fixures_dir)
+        html_path = compiled_path(
+            name, hashlib.sha1(raw_contents).hexdigest())
+        if os.path.exists(html_path):
+            with open(html_path, encoding="utf-8") as fo:
+                html = fo.read()
+        else:
+            html = compile_rst(raw_contents)
+            os.makedirs(COMPILED_DIR, exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(html_path, os.getpid())
+            with open(tmp_path, "w", encoding="utf-8") as fo:
+                fo.write(html)
+            os.replace(tmp_path, html_path)
+        __compiled__[name] = (version, html)
+    return html
+
+
+class HelpPages(Mapping):
+    """Read-only mapping of help page name to HTML that compiles pages on
+    first access"""
+
+    def __getitem__(self, name):
+        html = get_help(name)
+        if html is None:
+            raise KeyError(name)
+        return html
+
+    def __iter__(self):
+        return iter(help_names())
+
+    def __len__(self):
+        return len(help_names())
+
+help_loader = HelpPages()
+
+@click.command()
+def compile_help():
+    """Compiles every help rst file and removes stale compiled pages"""
+    current = set()
+    for name in help_names():
+        get_help(name)
+        current.add(os.path.basename(compiled_path(
+            name,
+            hashlib.sha1(get_file("{}.rst".format(name))).hexdigest())))
+        print("Compiled {}".format(name))
+    if not os.path.exists(COMPILED_DIR):
+        return
+    for filename in os.listdir(COMPILED_DIR):
+        if not filename in current:
+            os.remove(os.path.join(COMPILED_DIR, filename))
+
+if __name__ == "__main__":
+    compile_help()
@@ -3,31 +3,220 @@ Flask using Elasticsearch"""
 __author__ = "Jeremy Nelson"
 
 import datetime
+import gzip
+import hashlib
+import ipaddress
+import json
 import os
-import requests
+import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 HOME = os.path.abspath(os.curdir)
 with open(os.path.join(HOME, "VERSION")) as fo:
     VERSION = fo.read()
 
-from flask import abort, jsonify, render_template, redirect, request,\
-    Response, url_for, current_app
-from . import cache, REPO_SEARCH
+import requests
+from flask import abort, g, jsonify, redirect, request, Response, url_for,\
+    current_app
+from flask import render_template as flask_render_template
+from . import cache, REPO_SEARCH, SINGLE_FLIGHT, THUMBNAIL_CACHE
 from .blueprint import aristotle
 from .forms import SimpleSearch
-from search import browse, filter_query, get_aggregations, get_detail, get_pid,\
-    specific_search
+from search import FEDORA, browse, filter_query, get_detail, get_pid, get_titles,\
+    index_generation, sort_aggregations, specific_search, suggest
+from search.metrics import REGISTRY, format_metric, start_timings,\
+    stop_timings, timer, with_timings
+
+# Addresses or networks allowed to read /metrics unless the app's
+# METRICS_ALLOW config overrides them
+METRICS_ALLOW = ["127.0.0.1", "::1"]
+
+# Thread pool for running a page's independent Elasticsearch queries
+# concurrently
+PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+def lookup(function, *args):
+    """Function submits a search function to PAGE_EXECUTOR and returns the
+    Future, repeated lookups with the same arguments within a request
+    share the first Future.
+
+    Args:
+        function -- search function i.e. browse or get_detail
+        args -- Positional arguments for the function
+    """
+    if not hasattr(g, "lookups"):
+        g.lookups = dict()
+    key = (function.__name__,) + args
+    if not key in g.lookups:
+        g.lookups[key] = PAGE_EXECUTOR.submit(with_timings(function), *args)
+    return g.lookups[key]
+
+def render_template(template, **context):
+    """Function renders a template and records the rendering time, which
+    includes any lookups made by the template filters
+
+    Args:
+        template -- Template name
+    """
+    with timer("render", template):
+        return flask_render_template(template, **context)
+
+@aristotle.before_app_request
+def start_request_timings():
+    g.request_start = time.perf_counter()
+    start_timings()
+
+@aristotle.after_app_request
+def add_server_timing(response):
+    """Adds the request's Elasticsearch, Fedora and rendering times as a
+    Server-Timing header and records the request in the view histogram"""
+    timings = stop_timings()
+    if not hasattr(g, "request_start"):
+        return response
+    total = time.perf_counter() - g.request_start
+    REGISTRY.observe("request", total, view=request.endpoint or "unknown")
+    if timings is not None:
+        response.headers["Server-Timing"] = timings.server_timing(total)
+    return response
+
+@aristotle.after_app_request
+def cache_static_assets(response):
+    """Marks fingerprinted static assets immutable when Flask serves them
+    instead of nginx or Apache"""
+    if request.path.startswith("/static/dist/") and\
+       response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response
+
+def metrics_allowed(address):
+    """Function returns True if address is in the app's METRICS_ALLOW list
+    of addresses and networks, an empty list disables /metrics
+
+    Args:
+        address -- Client IP address
+    """
+    try:
+        client = ipaddress.ip_address(address or "")
+    except ValueError:
+        return False
+    for network in current_app.config.get("METRICS_ALLOW", METRICS_ALLOW):
+        try:
+            if client in ipaddress.ip_network(network, strict=False):
+                return True
+        except ValueError:
+            continue
+    return False
+
+@aristotle.route("/metrics")
+def metrics():
+    """View returns the request and backend latency histograms and the
+    cache counters in the Prometheus text format to the METRICS_ALLOW
+    addresses, other clients get a 404"""
+    if not metrics_allowed(request.remote_addr):
+        abort(404)
+    lines = [REGISTRY.exposition().rstrip("\n")]
+    stats = cache.stats()
+    lines.append("# TYPE digitalcc_cache_hits_total counter")
+    for tier in ["memory", "backend"]:
+        lines.append(format_metric(
+            "digitalcc_cache_hits_total",
+            stats["{}_hits".format(tier)],
+            (("tier", tier),)))
+    for name in ["misses", "sets"]:
+        lines.append("# TYPE digitalcc_cache_{}_total counter".format(name))
+        lines.append(format_metric(
+            "digitalcc_cache_{}_total".format(name), stats[name]))
+    lines.append("# TYPE digitalcc_cache_memory_bytes gauge")
+    lines.append(format_metric(
+        "digitalcc_cache_memory_bytes", stats["memory_bytes"]))
+    lines.append("# TYPE digitalcc_thumbnail_cache_bytes gauge")
+    lines.append(format_metric(
+        "digitalcc_thumbnail_cache_bytes", THUMBNAIL_CACHE.size))
+    return Response("\n".join(lines) + "\n",
+                    mimetype="text/plain; version=0.0.4")
 
 @aristotle.route("/about")
 def about_aristotle():
     """Displays details of current version of Aristotle"""
-    index_created_on = REPO_SEARCH.indices.get('repository').get('repository').get('settings').get('index').get('creation_date')
+    # repository may be an alias to a timestamped index built by reindex
+    index_info = list(REPO_SEARCH.indices.get('repository').values())[0]
+    index_created_on = index_info.get('settings').get('index').get('creation_date')
     indexed_on = datetime.datetime.utcfromtimestamp(int(index_created_on[0:10]))
     return render_template("discovery/About.html",
         indexed_on = indexed_on,
         version = VERSION)
     
 
+def fresh_entry(cache_key, ttl):
+    """Function returns the cache entry for cache_key if it was created
+    less than ttl seconds ago, otherwise None
+
+    Args:
+        cache_key -- Cache key
+        ttl -- Seconds an entry is fresh
+    """
+    entry = cache.get(cache_key)
+    if entry is None or time.time() - entry.get("created", 0) > ttl:
+        return None
+    return entry
+
+def json_entry(body, etag):
+    """Function returns a cache entry for JSON bytes with the gzipped copy
+    compressed once at cache-fill time
+
+    Args:
+        body -- JSON bytes
+        etag -- Entity tag for the body
+    """
+    return {"json": body,
+            "gzip": gzip.compress(body, 6),
+            "etag": etag}
+
+def json_response(entry, max_age):
+    """Function serves a json_entry as-is, gzipped if the client accepts
+    it, or a 304 if the client's copy is current
+
+    Args:
+        entry -- Dictionary from json_entry
+        max_age -- Cache-Control max-age in seconds
+    """
+    if entry["etag"] in request.if_none_match:
+        response = Response(status=304)
+    elif "gzip" in request.accept_encodings:
+        response = Response(entry["gzip"], mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(entry["json"], mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    response.set_etag(entry["etag"])
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
+
+# Seconds a cached browse result is fresh and then may be served stale
+# while one worker refreshes it
+BROWSE_CACHE_TTL = 300
+BROWSE_CACHE_STALE = 600
+
+def refresh_browse(cache_key, pid, from_, after):
+    """Function runs browse and stores its JSON with its creation time in
+    the cache
+
+    Returns:
+        The cache entry
+    """
+    body = browse(pid, from_, after, raw=True)
+    entry = json_entry(body, hashlib.sha1(body).hexdigest())
+    entry["created"] = time.time()
+    cache.set(cache_key, entry, timeout=BROWSE_CACHE_TTL + BROWSE_CACHE_STALE)
+    return entry
+
 @aristotle.route("/browse", methods=["POST", "GET"])
 def browser():
     """Browse view for AJAX call from client based on the PID in the
@@ -38,15 +227,23 @@ def browser():
     if request.method.startswith("POST"):
         pid = request.form["pid"]
         from_ = request.form.get("from", 0)
+        after = request.form.get("after")
     else:
         pid = request.args.get('pid')
         from_ = request.args.get('from', 0)
-    cache_key = "{}-{}".format(pid, from_)
-    browsed = cache.get(cache_key)
-    if not browsed:
-        browsed = browse(pid, from_)
-        cache.set(cache_key, browsed)
-    return jsonify(browsed)
+        after = request.args.get("after")
+    cache_key = "browse-{}-{}".format(pid, from_)
+    if after is not None:
+        cache_key = "browse-{}-after-{}".format(pid, after)
+    entry = cache.get(cache_key)
+    if entry is None or\
+       time.time() - entry.get("created", 0) > BROWSE_CACHE_TTL:
+        entry = SINGLE_FLIGHT.run(
+            cache_key,
+            lambda: refresh_browse(cache_key, pid, from_, after),
+            lambda: fresh_entry(cache_key, BROWSE_CACHE_TTL),
+            stale=entry)
+    return json_response(entry, BROWSE_CACHE_TTL)
 
 @aristotle.route("/contribute")
 def view_contribute():
@@ -60,6 +257,152 @@ def view_takedownpolicy():
 def view_help():
     return render_template("discovery/Help.html")	
 	
+# Request headers passed through to Fedora and response headers passed
+# back to the client when proxying datastreams
+PROXY_REQUEST_HEADERS = ["Range", "If-Range", "If-None-Match",
+                         "If-Modified-Since"]
+PROXY_RESPONSE_HEADERS = ["Accept-Ranges", "Content-Encoding",
+                          "Content-Length", "Content-Range", "ETag",
+                          "Last-Modified"]
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def stream_datastream(fedora_url, mimetype=None):
+    """Function proxies a Fedora datastream to the client in chunks instead
+    of loading the datastream into memory. Range and conditional headers
+    are passed through so Fedora can return 206 or 304 responses, and the
+    body is relayed undecoded with the client's Accept-Encoding so
+    Content-Length and Content-Encoding stay correct.
+
+    Args:
+        fedora_url -- URL to the Fedora datastream content
+        mimetype -- Optional mimetype, defaults to Fedora's Content-Type
+    """
+    headers = {name: request.headers[name]
+               for name in PROXY_REQUEST_HEADERS
+               if name in request.headers}
+    headers["Accept-Encoding"] = request.headers.get(
+        "Accept-Encoding", "identity")
+    fedora_result = FEDORA.get(fedora_url, headers=headers, stream=True)
+    if fedora_result.status_code == 404:
+        fedora_result.close()
+        abort(404)
+    if fedora_result.status_code in (401, 403):
+        fedora_result.close()
+        abort(403)
+    if fedora_result.status_code > 399 and fedora_result.status_code != 416:
+        fedora_result.close()
+        abort(500)
+
+    def generate():
+        try:
+            for chunk in fedora_result.raw.stream(STREAM_CHUNK_SIZE,
+                                                  decode_content=False):
+                yield chunk
+        finally:
+            fedora_result.close()
+
+    response = Response(
+        generate(),
+        status=fedora_result.status_code,
+        mimetype=mimetype or fedora_result.headers.get('Content-Type'),
+        direct_passthrough=True)
+    for name in PROXY_RESPONSE_HEADERS:
+        if name in fedora_result.headers:
+            response.headers[name] = fedora_result.headers[name]
+    response.vary.add("Accept-Encoding")
+    return response
+	
+# Seconds thumbnails and missing thumbnails stay cached
+THUMBNAIL_TTL = 86400
+THUMBNAIL_MISSING_TTL = 3600
+
+def default_thumbnail():
+    """Function returns the default thumbnail image's bytes"""
+    thumbnail = cache.get('default-thumbnail')
+    if not thumbnail:
+        with current_app.open_resource("static/img/default-tn.png") as fo:
+            thumbnail = fo.read()
+            cache.set('default-thumbnail', thumbnail)
+    return thumbnail
+
+def get_thumbnail(pid):
+    """Function returns a (content, mimetype, etag) tuple for a pid's TN
+    datastream, checking the in-process THUMBNAIL_CACHE and then the
+    on-disk cache before fetching from Fedora. Missing thumbnails are
+    cached with a None content for THUMBNAIL_MISSING_TTL seconds, None is
+    returned and nothing cached if Fedora fails.
+
+    Args:
+        pid -- PID of Fedora Object
+    """
+    cache_key = "thumbnail-{}".format(pid)
+    entry = THUMBNAIL_CACHE.get(cache_key)
+    if entry is not None:
+        return entry
+    # THUMBNAIL_CACHE is this process's copy, the shared cache's memory
+    # tier is skipped so the bytes are not held twice
+    entry = cache.get(cache_key, memory=False)
+    if entry is not None:
+        # Missing thumbnails keep the shorter TTL when promoted
+        THUMBNAIL_CACHE.set(
+            cache_key,
+            entry,
+            ttl=THUMBNAIL_MISSING_TTL if entry[0] is None else THUMBNAIL_TTL)
+        return entry
+    thumbnail_url = "{}{}/datastreams/TN/content".format(
+        current_app.config.get("REST_URL"),
+        pid)
+    try:
+        tn_result = FEDORA.get(thumbnail_url)
+    except requests.exceptions.RequestException:
+        return None
+    if tn_result.status_code == 404:
+        entry, ttl = (None, None, None), THUMBNAIL_MISSING_TTL
+    elif tn_result.status_code > 399:
+        # Don't cache errors from Fedora
+        return None
+    else:
+        entry = (tn_result.content,
+                 tn_result.headers.get('Content-Type', "image/jpg"),
+                 hashlib.md5(tn_result.content).hexdigest())
+        ttl = THUMBNAIL_TTL
+    THUMBNAIL_CACHE.set(cache_key, entry, ttl=ttl)
+    cache.set(cache_key, entry, timeout=ttl, memory=False)
+    return entry
+
+def thumbnail_response(pid):
+    """Function returns a cacheable thumbnail response for a pid, with a
+    304 response when the client's If-None-Match matches the ETag. The
+    default thumbnail for a missing TN is cached as long as the server
+    caches the miss and is not stored at all when Fedora failed.
+
+    Args:
+        pid -- PID of Fedora Object
+    """
+    entry = get_thumbnail(pid)
+    max_age = THUMBNAIL_TTL
+    if entry is None:
+        thumbnail, mime_type, etag = None, None, None
+        max_age = None
+    else:
+        thumbnail, mime_type, etag = entry
+        if thumbnail is None:
+            max_age = THUMBNAIL_MISSING_TTL
+    if thumbnail is None:
+        thumbnail, mime_type = default_thumbnail(), "image/png"
+        etag = "default-tn"
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(thumbnail, mimetype=mime_type)
+    response.set_etag(etag)
+    if max_age is None:
+        response.cache_control.no_store = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
 @aristotle.route("/pid/<pid>/datastream/<dsid>")
 @aristotle.route("/pid/<pid>/datastream/<dsid>.<ext>")
 def get_datastream(pid, dsid, ext=None):
@@ -73,12 +416,7 @@ def get_datastream(pid, dsid, ext=None):
         current_app.config.get("REST_URL"),
         pid,
         dsid)
-    exists_result = requests.get(fedora_url)
-    if exists_result.status_code == 404:
-        abort(404)
-    return Response(
-        exists_result.content, 
-        mimetype=exists_result.headers.get('Content-Type'))
+    return stream_datastream(fedora_url)
 
 
 @aristotle.route("/detail", methods=["POST"])
@@ -103,17 +441,7 @@ def image(uid):
     Args:
         uid: Elasticsearch ID
     """
-    pid = get_pid(uid)
-    thumbnail_url = "{}{}/datastreams/TN/content".format(
-        app.config.get("REST_URL"),
-        pid)
-    raw_thumbnail = cache.get(thumbnail_url)
-    if not raw_thumbnail:
-        result = requests.get(thumbnail_url)
-        if result.status_code > 399:
-           abort(500)
-        #raw_thumbnail = result.text
-        return Response(result.text, mimetype="image/jpeg")
+    return thumbnail_response(get_pid(uid))
 
 @aristotle.route("/advanced-search",  methods=["POST", "GET"])
 def advanced_search():
@@ -129,6 +457,122 @@ def advanced_search():
         mode=request.args.get('mode', None)
     )
 
+# Seconds a cached search result is fresh and then may be served stale
+# while it is refreshed in the background
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_STALE = 600
+SEARCH_REFRESHING = set()
+SEARCH_REFRESH_LOCK = threading.Lock()
+
+def run_search(mode, query, facet, facet_val, size, from_, after, raw=False):
+    """Function dispatches a /search request to the search function for
+    the mode and returns the results, as JSON bytes if raw is True"""
+    search_results = None
+    if mode in ["creator", "title", "subject", "number"]:
+         search_results = specific_search(
+                query,
+                mode,
+                size,
+                from_,
+                after=after,
+                raw=raw)
+    if mode.startswith("facet"):
+        search_results = filter_query(
+            facet, 
+            facet_val, 
+            query,
+            size,
+            from_,
+            after,
+            raw=raw)
+    if not search_results and query is not None:
+       search_results = specific_search(
+           query,
+           "keyword",
+           size,
+           from_,
+           after=after,
+           raw=raw)
+    return search_results
+
+def search_cache_key(mode, query, facet, facet_val, size, from_, after,
+                     raw=False):
+    """Function normalizes the search parameters and returns the cache key,
+    which includes the index generation so a reindex invalidates it"""
+    def normalize(value):
+        if value is None:
+            return None
+        return re.sub(r"\s+", " ", str(value)).strip()
+    try:
+        size, from_ = int(size), int(from_)
+    except ValueError:
+        abort(400)
+    params = [normalize(mode), normalize(query), normalize(facet),
+              normalize(facet_val), size, from_, after, raw,
+              index_generation()]
+    return "search-{}".format(
+        hashlib.sha1(json.dumps(params).encode()).hexdigest())
+
+def refresh_search(cache_key, *args):
+    """Function runs a search and stores the results with its creation time
+    in the cache. Raw results are always stored as a json_entry with a
+    content-hash ETag, so an unchanged refresh keeps the ETag, and a search
+    that ran no query is JSON null
+
+    Returns:
+        The cache entry
+    """
+    created = time.time()
+    results = run_search(*args)
+    raw = args[-1]
+    if raw:
+        if not isinstance(results, bytes):
+            results = json.dumps(results).encode()
+        entry = json_entry(results, hashlib.sha1(results).hexdigest())
+    else:
+        entry = {"results": results}
+    entry["created"] = created
+    cache.set(cache_key, entry, timeout=SEARCH_CACHE_TTL + SEARCH_CACHE_STALE)
+    return entry
+
+def refresh_search_background(cache_key, stale, *args):
+    """Function refreshes a stale search on PAGE_EXECUTOR, at most one
+    refresh per key at a time on the host"""
+    with SEARCH_REFRESH_LOCK:
+        if cache_key in SEARCH_REFRESHING:
+            return
+        SEARCH_REFRESHING.add(cache_key)
+
+    def refresh():
+        try:
+            SINGLE_FLIGHT.run(
+                cache_key,
+                lambda: refresh_search(cache_key, *args),
+                lambda: fresh_entry(cache_key, SEARCH_CACHE_TTL),
+                stale=stale)
+        finally:
+            with SEARCH_REFRESH_LOCK:
+                SEARCH_REFRESHING.discard(cache_key)
+
+    PAGE_EXECUTOR.submit(refresh)
+
+def cached_search(mode, query, facet, facet_val, size, from_, after,
+                  raw=False):
+    """Function returns the cache entry for the search parameters, entries
+    older than SEARCH_CACHE_TTL are served stale while they are refreshed
+    in the background and concurrent misses wait for a single search"""
+    args = (mode, query, facet, facet_val, size, from_, after, raw)
+    cache_key = search_cache_key(*args)
+    entry = cache.get(cache_key)
+    if entry is None:
+        entry = SINGLE_FLIGHT.run(
+            cache_key,
+            lambda: refresh_search(cache_key, *args),
+            lambda: fresh_entry(cache_key, SEARCH_CACHE_TTL))
+    elif time.time() - entry["created"] > SEARCH_CACHE_TTL:
+        refresh_search_background(cache_key, entry, *args)
+    return entry
+
 @aristotle.route("/search", methods=["POST", "GET"])
 def query():
     """View returns Elasticsearch query search results
@@ -136,14 +580,13 @@ def query():
     Returns:
         jsonified version of the search result
     """
-    # DU: Examine query
-    print("DU: Query function data:");
     if request.method.startswith("POST"):
         mode = request.form.get('mode', 'keyword')
         facet = request.form.get('facet')
         facet_val = request.form.get('val')
         from_ = request.form.get('from', 0)
         size = request.form.get('size', 25)
+        after = request.form.get('after')
         query = request.form["q"]
 
     else:
@@ -151,44 +594,35 @@ def query():
         facet = request.args.get('facet')
         from_ = request.args.get('from', 0)
         size = request.args.get('size', 25)
+        after = request.args.get('after')
         facet_val = request.args.get('val')
         query = request.args.get('q', None)
 
-    search_results = None
-    if mode in ["creator", "title", "subject", "number"]:
-         search_results = specific_search(
-                query,
-                mode,
-                size,
-                from_)
-    if mode.startswith("facet"):
-        search_results = filter_query(
-            facet, 
-            facet_val, 
-            query,
-            size,
-            from_)
-    if not search_results and query is not None:
-       search_results = specific_search(
-           query,
-           "keyword",
-           size,
-           from_)
-    if "html" in request.headers.get("Accept"):
-        return render_template(
+    if "html" in request.headers.get("Accept", ""):
+        entry = cached_search(
+            mode, query, facet, facet_val, size, from_, after)
+        # The page's ETag hashes the rendered HTML, which also changes with
+        # the scraped chrome, so unchanged pages revalidate with a 304
+        response = Response(render_template(
             'discovery/search-results.html',
             facet=facet,
             facet_val=facet_val,
             mode=mode,
-            results = search_results,
+            results = entry["results"],
             search_form=SimpleSearch(),
             q=query,
             size=size,
             offset=from_
-        )
+        ), mimetype="text/html")
+        response.add_etag()
+        response.cache_control.public = True
+        response.cache_control.max_age = SEARCH_CACHE_TTL
+        return response.make_conditional(request)
     else:
-        return jsonify(search_results)
-    
+        # JSON clients are served the Elasticsearch response bytes
+        entry = cached_search(
+            mode, query, facet, facet_val, size, from_, after, raw=True)
+        return json_response(entry, SEARCH_CACHE_TTL)
 
 
 
@@ -202,11 +636,11 @@ def fedora_datastream(pid, dsid, ext):
         dsid -- Datastream ID
         ext -- Extension for datastream
     """
-    ds_url = "{}{}/datastream/{}".format(
-        app.config.get("REST_URL"),
+    ds_url = "{}{}/datastreams/{}/content".format(
+        current_app.config.get("REST_URL"),
         pid,
         dsid)
-    result = requests.get(ds_url)
+    mimetype = None
     if ext.startswith("pdf"):
         mimetype = 'application/pdf'
     if ext.startswith("jpg"):
@@ -215,7 +649,24 @@ def fedora_datastream(pid, dsid, ext):
         mimetype = "audio/mpeg"
     if ext.startswith("wav"):
         mimetype = "audio/wav"
-    return Response(result.text, mimetype=mimetype) 
+    return stream_datastream(ds_url, mimetype) 
+
+@aristotle.route("/suggest")
+def suggester():
+    """View returns typeahead completions of titles, creators and subjects
+    for the q prefix
+
+    Returns:
+        jsonified dictionary of completions by kind
+    """
+    try:
+        size = min(max(int(request.args.get('size', 5)), 1), 20)
+    except ValueError:
+        abort(400)
+    response = jsonify(suggest(request.args.get('q', ''), size))
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response
 
 @aristotle.route("/<identifier>/<value>")
 def fedora_object(identifier, value):
@@ -230,23 +681,21 @@ def fedora_object(identifier, value):
     Returns:
         Rendered HTML from template and Elasticsearch
     """
-    # DU DEV
-    print("DU: fed_obj: identifier:", identifier)
-    print("DU: fed_obj: value:", value)
-
     if identifier.startswith("pid"):
         offset = request.args.get("offset", 0)
-        results = browse(value, from_=offset)
-
-        # DU DEV
-        print("DU: search results obj", results)
+        # Runs the browse and detail queries concurrently
+        browse_future = lookup(browse, value, offset)
+        detail_future = lookup(get_detail, value)
+        results = browse_future.result()
 
         if results['hits']['total'] > 1:
 
-            detail_result = get_detail(value)
-            print("DU: detail_result: ", detail_result);
+            detail_result = detail_future.result()
             if not 'islandora:collectionCModel' in\
                 detail_result['hits']['hits'][0]['_source']['content_models']:
+                # Resolves breadcrumb titles in one query before rendering
+                get_titles(detail_result['hits']['hits'][0]['_source'].get(
+                    'inCollections', []))
                 return render_template(
                     'discovery/detail.html',
                     pid=value,
@@ -255,33 +704,20 @@ def fedora_object(identifier, value):
         if value == current_app.config.get("INITIAL_PID"):
             return redirect(url_for('aristotle.index'))
 
+        info = detail_future.result()['hits']['hits'][0]['_source']
+        get_titles(info.get('inCollections', []))
         return render_template(
             'discovery/index.html',
             pid=value,
             results=results,
-            info=get_detail(value)['hits']['hits'][0]['_source'],
+            info=info,
             search_form=SimpleSearch(),
             q=value,
             offset=offset,
-            facets=get_aggregations(value))
+            facets=sort_aggregations(results['aggregations']))
 
     if identifier.startswith("thumbnail"):
-        thumbnail_url = "{}{}/datastreams/TN/content".format(
-            current_app.config.get("REST_URL"),
-            value)
-        tn_result = requests.get(thumbnail_url)
-        if tn_result.status_code == 404:
-            thumbnail = cache.get('default-thumbnail')
-            if not thumbnail:
-                with current_app.open_resource(
-                    "static/img/default-tn.png") as fo:
-                    thumbnail = fo.read()
-                    cache.set('default-thumbnail', thumbnail)
-            mime_type = "image/png"
-        else:
-            thumbnail = tn_result.content
-            mime_type = "image/jpg"
-        return Response(thumbnail, mimetype=mime_type)
+        return thumbnail_response(value)
 
 
     return "Should return detail for {} {}".format(identifier, value)
@@ -302,5 +738,6 @@ def index():
         q=query,
         results = results,
         search_form=SimpleSearch(),
-        mode=mode
+        mode=mode,
+        offset=0
     )
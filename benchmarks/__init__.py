@@ -0,0 +1,3 @@
+"""Benchmark suite for the discovery views, runs the Aristotle blueprint
+against local stand-ins for Elasticsearch and Fedora"""
+__author__ = "Jeremy Nelson"
@@ -0,0 +1,257 @@
+"""Module provides fake Elasticsearch and Fedora HTTP servers loaded with a
+synthetic repository for the benchmarks"""
+__author__ = "Jeremy Nelson"
+
+import json
+import random
+import re
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+ROOT_PID = "codu:root"
+TOPICS = ["Colorado", "Mining", "Theatre", "Geology", "Denver", "Railroads",
+          "Photography", "Music", "Architecture", "Students"]
+FORMATS = ["still image", "text", "sound recording", "moving image"]
+
+
+def synthetic_repository(size=1000, seed=42):
+    """Function returns a dictionary of pid to repository documents for a
+    root collection, ten sub-collections and size objects
+
+    Args:
+        size -- Number of objects
+        seed -- Random seed so runs are repeatable
+    """
+    rand = random.Random(seed)
+    docs = dict()
+    collections = ["codu:c{}".format(i) for i in range(10)]
+    for pid in [ROOT_PID] + collections:
+        docs[pid] = {
+            "pid": pid,
+            "titlePrincipal": "Collection {}".format(pid),
+            "titleInfo": {"title": ["Collection {}".format(pid)]},
+            "content_models": ["islandora:collectionCModel"],
+            "inCollections": [] if pid == ROOT_PID else [ROOT_PID],
+            "subject": {"topic": [], "geographic": [], "temporal": []},
+            "datastreams": []
+        }
+    for i in range(size):
+        pid = "codu:{}".format(i)
+        title = "{} {} {}".format(
+            rand.choice(TOPICS), rand.choice(TOPICS), i)
+        docs[pid] = {
+            "pid": pid,
+            "titlePrincipal": title,
+            "titleInfo": {"title": [title]},
+            "creator": ["Creator {}".format(rand.randint(1, 50))],
+            "dateCreated": str(rand.randint(1870, 2017)),
+            "typeOfResource": rand.choice(FORMATS),
+            "language": ["English"],
+            "genre": ["photographs"],
+            "abstract": ["Synthetic abstract " * rand.randint(5, 40)],
+            "subject": {"topic": rand.sample(TOPICS, 3),
+                        "geographic": ["Colorado Springs"],
+                        "temporal": ["20th century"]},
+            "content_models": ["islandora:sp_large_image_cmodel"],
+            "inCollections": [ROOT_PID, rand.choice(collections)],
+            "datastreams": [
+                {"pid": pid, "dsid": dsid, "label": dsid, "mimeType": mime}
+                for dsid, mime in [("OBJ", "image/jpeg"),
+                                   ("TN", "image/jpeg"),
+                                   ("MODS", "text/xml")]]
+        }
+    return docs
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    """Answers the Elasticsearch APIs the search package uses from the
+    server's synthetic repository"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send__(self, body, status=200):
+        raw_body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw_body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(raw_body)
+
+    def __body__(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length < 1:
+            return dict()
+        return json.loads(self.rfile.read(length).decode())
+
+    def __matches__(self, query):
+        """Method returns the documents matching the pid term and terms
+        queries, any other query matches every document"""
+        docs = self.server.docs
+        raw_query = json.dumps(query)
+        terms = re.search(r'"terms": \{"pid": (\[[^\]]*\])', raw_query)
+        if terms:
+            return [docs[pid] for pid in json.loads(terms.group(1))
+                    if pid in docs]
+        term = re.search(r'"term": \{"pid": "([^"]+)"', raw_query)
+        if term:
+            return [docs[term.group(1)]] if term.group(1) in docs else []
+        return list(docs.values())
+
+    def __aggregations__(self, aggs, total):
+        output = dict()
+        for name, agg in aggs.items():
+            sub_aggs = agg.get("aggs", agg.get("aggregations", {}))
+            if "filter" in agg:
+                output[name] = {"doc_count": total}
+                output[name].update(self.__aggregations__(sub_aggs, total))
+            else:
+                output[name] = {
+                    "doc_count_error_upper_bound": 0,
+                    "sum_other_doc_count": 0,
+                    "buckets": [{"key": topic, "doc_count": total // (i + 2)}
+                                for i, topic in enumerate(TOPICS)]}
+        return output
+
+    def __project__(self, doc, source):
+        """Method applies a _source includes and excludes projection,
+        dotted fields are matched on their top-level name"""
+        if source is True or source is None:
+            return doc
+        if isinstance(source, list):
+            source = {"includes": source}
+        includes = [field.split(".")[0] for field in source.get("includes", [])]
+        excludes = [field.split(".")[0] for field in source.get("excludes", [])]
+        return {key: value for key, value in doc.items()
+                if (len(includes) < 1 or key in includes)
+                and not key in excludes}
+
+    def __suggest__(self, suggesters, source):
+        """Method answers completion suggesters with the document inputs
+        starting with the prefix in the suggester's kind context"""
+        from search.indexer import suggest_inputs
+        output = dict()
+        for name, suggester in suggesters.items():
+            prefix = suggester["prefix"].lower()
+            completion = suggester["completion"]
+            kinds = completion.get("contexts", {}).get("kind", [])
+            options = []
+            for doc in self.server.docs.values():
+                for row in suggest_inputs(doc):
+                    kind = row["contexts"]["kind"][0]
+                    if len(kinds) > 0 and not kind in kinds:
+                        continue
+                    options.extend(
+                        {"text": term, "_index": "repository", "_type": "mods",
+                         "_id": doc["pid"], "_score": 1.0,
+                         "_source": self.__project__(doc, source)}
+                        for term in row["input"]
+                        if term.lower().startswith(prefix))
+                if len(options) >= completion.get("size", 5):
+                    break
+            output[name] = [{"text": prefix, "offset": 0,
+                             "length": len(prefix),
+                             "options": options[:completion.get("size", 5)]}]
+        return output
+
+    def __search__(self, params):
+        body = self.__body__()
+        size = int(params.get("size", [body.get("size", 10)])[0])
+        from_ = int(params.get("from", [body.get("from", 0)])[0])
+        matches = self.__matches__(body.get("query", {}))
+        hits = []
+        for doc in matches[from_:from_ + size]:
+            hit = {"_index": "repository", "_type": "mods", "_id": doc["pid"],
+                   "_score": 1.0,
+                   "_source": self.__project__(doc, body.get("_source"))}
+            if "sort" in body:
+                hit["sort"] = [doc["titleInfo"]["title"][0], doc["pid"]]
+            hits.append(hit)
+        result = {"took": 1,
+                  "timed_out": False,
+                  "_shards": {"total": 1, "successful": 1, "failed": 0},
+                  "hits": {"total": len(matches), "max_score": 1.0,
+                           "hits": hits}}
+        if "suggest" in body:
+            result["suggest"] = self.__suggest__(
+                body["suggest"], body.get("_source"))
+        aggs = body.get("aggs", body.get("aggregations"))
+        if aggs:
+            result["aggregations"] = self.__aggregations__(aggs, len(matches))
+        return result
+
+    def __route__(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        parts = [part for part in url.path.split("/") if part]
+        if len(parts) < 1:
+            return self.__send__({"version": {"number": "5.6.0"}})
+        if parts[-1] == "_search":
+            return self.__send__(self.__search__(params))
+        if parts[-1] == "_source" and parts[-2] in self.server.docs:
+            return self.__send__(self.server.docs[parts[-2]])
+        if len(parts) == 1:
+            return self.__send__({
+                parts[0]: {"settings": {"index": {
+                    "creation_date": "1500000000000"}}}})
+        self.__send__({"found": False}, 404)
+
+    do_GET = do_POST = do_HEAD = __route__
+
+
+class FakeFedoraHandler(BaseHTTPRequestHandler):
+    """Answers Fedora REST datastream content requests with synthetic
+    bytes, thumbnails are small and other datastreams datastream_bytes"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        match = re.search(r"/objects/([^/]+)/datastreams/([^/]+)/content",
+                          self.path)
+        pid = urllib.parse.unquote(match.group(1)) if match else None
+        if pid is None or not pid in self.server.docs:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if match.group(2) == "TN":
+            content = self.server.thumbnail
+        else:
+            content = self.server.datastream
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start_servers(docs, datastream_bytes=1024 * 1024):
+    """Function starts the fake Elasticsearch and Fedora servers on free
+    local ports in daemon threads
+
+    Args:
+        docs -- Synthetic repository from synthetic_repository
+        datastream_bytes -- Size of non-thumbnail datastreams
+
+    Returns:
+        (elastic_server, fedora_server)
+    """
+    elastic = ThreadingHTTPServer(("127.0.0.1", 0), FakeElasticsearchHandler)
+    elastic.docs = docs
+    fedora = ThreadingHTTPServer(("127.0.0.1", 0), FakeFedoraHandler)
+    fedora.docs = docs
+    fedora.thumbnail = b"\xff\xd8\xff" + b"\x00" * 8 * 1024
+    fedora.datastream = b"\x00" * datastream_bytes
+    for server in (elastic, fedora):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return elastic, fedora
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Module runs the discovery view benchmarks and compares them with stored
+baselines. Each view is measured warm, after a first call fills the caches,
+and cold, with every cache cleared before each request.
+
+Run with python3 -m benchmarks.run --size 1000 --requests 200
+"""
+__author__ = "Jeremy Nelson"
+
+import click
+import contextlib
+import datetime
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from flask import Flask
+
+from .fakes import ROOT_PID, start_servers, synthetic_repository
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(BASE_DIR, "benchmarks", "baseline.json")
+JSON = {"Accept": "application/json"}
+
+# (name, method, path, form data, headers)
+SCENARIOS = [
+    ("home", "GET", "/", None, None),
+    ("browse", "GET", "/browse?pid={}".format(ROOT_PID), None, None),
+    ("search-keyword", "GET", "/search?mode=keyword&q=Colorado", None, JSON),
+    ("search-creator", "GET", "/search?mode=creator&q=Creator+7", None, JSON),
+    ("search-title", "GET", "/search?mode=title&q=Mining", None, JSON),
+    ("search-subject", "GET", "/search?mode=subject&q=Geology", None, JSON),
+    ("search-number", "GET", "/search?mode=number&q=codu:5", None, JSON),
+    ("search-facet", "GET", "/search?mode=facet&facet=Topic&val=Mining",
+     None, JSON),
+    ("detail", "POST", "/detail", {"pid": "codu:5"}, None),
+    ("pid-collection", "GET", "/pid/codu:c1", None, None),
+    ("pid-object", "GET", "/pid/codu:5", None, None),
+    ("thumbnail", "GET", "/thumbnail/codu:5", None, None),
+    ("suggest", "GET", "/suggest?q=Col", None, None)
+]
+
+
+def build_app(elastic, fedora):
+    """Function builds the Flask app with the aristotle blueprint pointed at
+    the fake servers and a temporary cache directory"""
+    sys.path.append(BASE_DIR)
+    import search
+    from search.cache import DiskCache
+    import aristotle
+    from aristotle.blueprint import aristotle as blueprint
+    for client in (search.REPO_SEARCH, search.RAW_SEARCH):
+        client.transport.set_connections(
+            [{"host": "127.0.0.1", "port": elastic.server_address[1]}])
+    aristotle.cache.backend = DiskCache(tempfile.mkdtemp(prefix="bench-cache-"))
+    app = Flask("app", root_path=BASE_DIR, template_folder="templates")
+    app.config.update(
+        INITIAL_PID=ROOT_PID,
+        REST_URL="http://127.0.0.1:{}/fedora/objects/".format(
+            fedora.server_address[1]),
+        SECRET_KEY="benchmark",
+        WTF_CSRF_ENABLED=False)
+    app.register_blueprint(blueprint)
+    return app
+
+def clear_caches():
+    """Function empties the response, thumbnail, title, suggestion and index
+    generation caches so the next request does all of its backend work"""
+    import search
+    import aristotle
+    aristotle.cache.clear()
+    for lru in (aristotle.THUMBNAIL_CACHE,
+                search.TITLE_CACHE,
+                search.SUGGEST_CACHE,
+                search.GENERATION_CACHE):
+        lru.clear()
+
+def call(client, scenario):
+    name, method, path, data, headers = scenario
+    response = client.open(path, method=method, data=data, headers=headers)
+    response.get_data()
+    if response.status_code > 399:
+        raise click.ClickException("{} returned {}".format(
+            name, response.status_code))
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def measure(app, scenario, total, concurrency):
+    """Function runs total requests for a scenario on concurrency threads
+    and returns the latencies in milliseconds and the elapsed seconds"""
+    latencies, lock = [], threading.Lock()
+    per_thread = max(total // concurrency, 1)
+
+    def worker():
+        client = app.test_client()
+        for i in range(per_thread):
+            start = time.perf_counter()
+            call(client, scenario)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+def measure_cold(app, scenario, samples):
+    """Function runs samples sequential requests for a scenario, clearing
+    the caches before each one, and returns the latencies in milliseconds
+    and the seconds spent in the requests"""
+    client = app.test_client()
+    latencies = []
+    for i in range(samples):
+        clear_caches()
+        start = time.perf_counter()
+        call(client, scenario)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, sum(latencies) / 1000
+
+def summarize(latencies, seconds, allocated):
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "throughput": len(latencies) / seconds,
+        "alloc_bytes": allocated
+    }
+
+def allocations(app, scenario, samples=10, cold=False):
+    """Function returns the mean peak bytes allocated per request, with cold
+    the caches are cleared before each request"""
+    client = app.test_client()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(samples):
+            if cold:
+                clear_caches()
+            tracemalloc.clear_traces()
+            base = tracemalloc.get_traced_memory()[0]
+            call(client, scenario)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return statistics.mean(peaks)
+
+@click.command()
+@click.option("--size", default=1000, help="Objects in the synthetic repository")
+@click.option("--requests", "total", default=200, help="Requests per view")
+@click.option("--cold-requests", default=20,
+              help="Requests per view with the caches cleared")
+@click.option("--concurrency", default=4, help="Concurrent clients")
+@click.option("--only", default=None, help="Comma separated scenario names")
+@click.option("--baseline", default=BASELINE_PATH, help="Baseline JSON file")
+@click.option("--save-baseline", is_flag=True,
+              help="Store these results as the new baseline")
+@click.option("--tolerance", default=0.2,
+              help="Allowed p95 regression before failing, 0.2 is 20%")
+def run(size, total, cold_requests, concurrency, only, baseline, save_baseline, tolerance):
+    """Benchmarks the discovery views against fake Elasticsearch and Fedora
+    servers"""
+    elastic, fedora = start_servers(synthetic_repository(size))
+    app = build_app(elastic, fedora)
+    scenarios = SCENARIOS
+    if only:
+        scenarios = [row for row in SCENARIOS if row[0] in only.split(",")]
+    previous = dict()
+    if os.path.exists(baseline):
+        with open(baseline) as fo:
+            previous = json.load(fo).get("results", {})
+    results, regressions = dict(), []
+    click.echo("{:<22}{:>9}{:>9}{:>9}{:>10}{:>12}{:>10}".format(
+        "view", "p50 ms", "p95 ms", "p99 ms", "req/s", "alloc KB", "p95 Δ"))
+    for scenario in scenarios:
+        with open(os.devnull, "w") as devnull,\
+             contextlib.redirect_stdout(devnull):
+            cold = summarize(
+                *measure_cold(app, scenario, cold_requests),
+                allocated=allocations(app, scenario, cold=True))
+            call(app.test_client(), scenario)
+            warm = summarize(
+                *measure(app, scenario, total, concurrency),
+                allocated=allocations(app, scenario))
+        # Warm results keep the view's name so older baselines compare
+        for name, result in [(scenario[0], warm),
+                             ("{}:cold".format(scenario[0]), cold)]:
+            results[name] = result
+            change = ""
+            if name in previous:
+                ratio = result["p95"] / max(previous[name]["p95"], 0.001) - 1
+                change = "{:+.0%}".format(ratio)
+                if ratio > tolerance:
+                    regressions.append(name)
+            click.echo("{:<22}{p50:>9.2f}{p95:>9.2f}{p99:>9.2f}"
+                       "{throughput:>10.1f}{kb:>12.1f}{change:>10}".format(
+                           name, kb=result["alloc_bytes"] / 1024,
+                           change=change, **result))
+    if save_baseline:
+        with open(baseline, "w") as fo:
+            json.dump({"created": datetime.datetime.utcnow().isoformat(),
+                       "size": size,
+                       "requests": total,
+                       "cold_requests": cold_requests,
+                       "concurrency": concurrency,
+                       "results": results}, fo, indent=2, sort_keys=True)
+        click.echo("Saved baseline to {}".format(baseline))
+    if len(regressions) > 0:
+        raise click.ClickException("p95 regressions over {:.0%}: {}".format(
+            tolerance, ", ".join(regressions)))
+
+if __name__ == "__main__":
+    run()
@@ -1,7 +1,9 @@
 __author__ = "Jeremy Nelson, Sarah Bogard"
 
+import click
 import csv
 import datetime
+import json
 import logging
 import mimetypes
 import os
@@ -9,10 +11,16 @@ import re
 import requests
 import rdflib
 import sys
+import tempfile
+import threading
+import traceback
 import urllib.parse
 import warnings
 import xml.etree.ElementTree as etree
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, Q
 from jinja2 import Template
@@ -21,6 +29,7 @@ from jinja2 import Template
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(BASE_DIR)
 from instance import conf as CONF
+from search.fedora import FedoraClient
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 
@@ -29,6 +38,14 @@ if hasattr(CONF, "ELASTIC_SEARCH"):
 else:
     REPO_SEARCH = Elasticsearch() # Use defaults
 
+FEDORA = FedoraClient(
+    rest_url=CONF.REST_URL,
+    ri_url=CONF.RI_URL,
+    auth=CONF.FEDORA_AUTH,
+    timeout=getattr(CONF, "FEDORA_TIMEOUT", (3.05, 300)),
+    retries=getattr(CONF, "FEDORA_RETRIES", 3),
+    pool_size=getattr(CONF, "FEDORA_POOL_SIZE", 10))
+
 with open(os.path.join(BASE_DIR, "repair", "mods.xml")) as fo:
     MODS_TEMPLATE = Template(fo.read())
 
@@ -36,6 +53,9 @@ with open(os.path.join(BASE_DIR, "repair", "rels-ext.xml")) as fo:
     RELS_EXT_TEMPLATE = Template(fo.read())
 
 
+# Checkpointed in place of a PID for rows a harvester deliberately skips
+SKIPPED = "skipped"
+
 GET_FILE_URL = "http://cdm16304.contentdm.oclc.org/utils/getfile/collection/"
 
 EXISTING_SPARQL = """SELECT DISTINCT ?s
@@ -44,6 +64,16 @@ WHERE {{
 }}
 """
 
+COLLECTION_EXISTING_SPARQL = """SELECT DISTINCT ?s ?title ?creator
+WHERE {{
+  ?s <fedora-rels-ext:isMemberOfCollection> <info:fedora/{0}> .
+  ?s <dc:title> ?title .
+  OPTIONAL {{ ?s <dc:creator> ?creator . }}
+}}
+ORDER BY ?s ?title ?creator
+LIMIT {1}
+OFFSET {2}"""
+
 GEOSCIML_BASIC = rdflib.Namespace("http://xmlns.geosciml.org/GeoSciML-Basic/4.0/")
 GEOSCIML_EXT = rdflib.Namespace("http://xmlns.geosciml.org/GeoSciML-Extension/4.0/")
 GEOSCIML_PORTRAYAL = rdflib.Namespace("http://xmlns.geosciml.org/geosciml-portrayal/4.0/")
@@ -51,7 +81,39 @@ GEOCONTAT_TYPE = rdflib.Namespace("http://resource.geosciml.org/classifierscheme
 GEOSTR_RANK = rdflib.Namespace("http://resource.geosciml.org/classifier/cgi/stratigraphicrank/")
 SCHEMA_ORG = rdflib.Namespace("https://schema.org/")
 
-def _add_datastream(pid, raw_datastream, ident, label, mime_type):
+# Maximum concurrent calls to each remote during a parallel harvest
+REMOTE_LIMITS = dict()
+
+def set_remote_limits(contentdm=4, fedora=4, ri=2):
+    """Function sets the maximum number of concurrent calls harvest workers
+    make to CONTENTdm, Fedora's REST API and Fedora's resource index
+
+    Args:
+        contentdm -- CONTENTdm downloads
+        fedora -- Fedora REST calls
+        ri -- Resource index SPARQL queries
+    """
+    REMOTE_LIMITS["contentdm"] = threading.BoundedSemaphore(contentdm)
+    REMOTE_LIMITS["fedora"] = threading.BoundedSemaphore(fedora)
+    REMOTE_LIMITS["ri"] = threading.BoundedSemaphore(ri)
+
+set_remote_limits()
+
+def _get_contentdm(file_url):
+    """Internal function downloads a file from CONTENTdm within the
+    CONTENTdm concurrency limit
+
+    Args:
+        file_url -- CONTENTdm getfile URL
+    """
+    with REMOTE_LIMITS["contentdm"]:
+        result = requests.get(file_url)
+        result.content
+    return result
+
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+
+def _add_datastream(pid, raw_datastream, ident, label, mime_type, stream=False):
     add_file_url = "{}{}/datastreams/{}?{}".format(
         CONF.REST_URL,
         pid,
@@ -59,16 +121,79 @@ def _add_datastream(pid, raw_datastream, ident, label, mime_type):
         urllib.parse.urlencode({"controlGroup": "M",
                "dsLabel": label,
                "mimeType": mime_type}))
-    repo_add_result = requests.post(
-         add_file_url,
-         files={"content": raw_datastream},
-         auth=CONF.FEDORA_AUTH)
+    if stream:
+        # Sends a file object or iterator as the request body instead of
+        # building a multipart body in memory
+        upload = {"data": raw_datastream,
+                  "headers": {"Content-Type": mime_type or\
+                                  "application/octet-stream"}}
+    else:
+        upload = {"files": {"content": raw_datastream}}
+    with REMOTE_LIMITS["fedora"]:
+        repo_add_result = FEDORA.post(add_file_url, **upload)
     if repo_add_result.status_code > 399:
         print("Error {} with {}".format(
             repo_add_result.status_code, add_file_url))
         return False
     return True
 
+def _transfer_datastream(file_url, pid, ident, label, mime_type, spool=False):
+    """Internal function streams a CONTENTdm file into a new Fedora
+    datastream in TRANSFER_CHUNK_SIZE chunks so the file is never held in
+    memory. With spool the file is first copied to a temporary file, which
+    releases the CONTENTdm connection before the upload and lets Fedora
+    receive a Content-Length.
+
+    Args:
+        file_url -- CONTENTdm getfile URL
+        pid -- PID of Fedora Object
+        ident -- Datastream ID
+        label -- Datastream label
+        mime_type -- Datastream mime type
+        spool -- Spool the download to a temporary file
+    Returns:
+        True if the datastream was added
+    """
+    with REMOTE_LIMITS["contentdm"]:
+        file_result = requests.get(file_url, stream=True)
+        if file_result.status_code > 399:
+            file_result.close()
+            print("Failed to get {}".format(file_url))
+            return False
+        if not spool:
+            try:
+                return _add_datastream(
+                    pid,
+                    file_result.iter_content(TRANSFER_CHUNK_SIZE),
+                    ident,
+                    label,
+                    mime_type,
+                    stream=True)
+            finally:
+                file_result.close()
+        spooled = tempfile.TemporaryFile()
+        try:
+            for chunk in file_result.iter_content(TRANSFER_CHUNK_SIZE):
+                spooled.write(chunk)
+        finally:
+            file_result.close()
+    with spooled:
+        spooled.seek(0)
+        return _add_datastream(pid, spooled, ident, label, mime_type,
+                               stream=True)
+
+def _require(succeeded, step, pid):
+    """Internal function raises a ValueError when an ingest step failed so
+    the record is logged and retried instead of checkpointed
+
+    Args:
+        succeeded -- Result of the step
+        step -- Description of the step
+        pid -- PID of Fedora Object
+    """
+    if not succeeded:
+        raise ValueError("Failed to {} for {}".format(step, pid))
+
 def _add_rels_ext(pid, collection_pid, content_model):
      rels_ext = RELS_EXT_TEMPLATE.render(
          object_pid = pid,
@@ -93,13 +218,8 @@ def _check_existing(title, creator):
         PID of exact match 
     """
     sparql = EXISTING_SPARQL.format(title)
-    existing_response = requests.post(
-        CONF.RI_URL,
-        data={"type": "tuples",
-              "lang": "sparql",
-               "format": "json",
-               "query": sparql},
-            auth=CONF.FEDORA_AUTH)
+    with REMOTE_LIMITS["ri"]:
+        existing_response = FEDORA.sparql(sparql)
     if existing_response.status_code > 399:
         return
         print("Error with {}\nSPARQL\n{}".format(title, sparql))
@@ -110,6 +230,42 @@ def _check_existing(title, creator):
         return existing_pids[0].get('s').split("/")[-1]
     
 
+def _prefetch_existing(collection_pid, page_size=5000):
+    """Internal function pages through the titles and creators of every
+    object in a collection and returns a dictionary index of title to a
+    dictionary of pid to the set of that pid's creators. Rows are ordered
+    by every selected variable so pages are stable, a pid whose rows span
+    two pages is merged.
+
+    Args:
+        collection_pid: PID of the collection
+        page_size: Rows returned by each SPARQL query
+    Returns:
+        dict index or None if the resource index returned an error
+    """
+    existing, offset = dict(), 0
+    while 1:
+        sparql = COLLECTION_EXISTING_SPARQL.format(
+            collection_pid,
+            page_size,
+            offset)
+        with REMOTE_LIMITS["ri"]:
+            existing_response = FEDORA.sparql(sparql)
+        if existing_response.status_code > 399:
+            print("Error {} prefetching {}".format(
+                existing_response.status_code, collection_pid))
+            return
+        rows = existing_response.json().get('results', [])
+        for row in rows:
+            pid = row.get('s').split("/")[-1]
+            creators = existing.setdefault(
+                row.get('title'), dict()).setdefault(pid, set())
+            if row.get('creator'):
+                creators.add(row.get('creator'))
+        if len(rows) < page_size:
+            return existing
+        offset += page_size
+
 def _convert_date(date_str):
     if len(date_str) > 8:
         return datetime.datetime(date_str, "%m/%d/%Y").strftime("%Y-%m-%d")
@@ -117,23 +273,69 @@ def _convert_date(date_str):
 
 class Harvester(object):
 
-    def __init__(self, filepath, collection_pid, conf=CONF):
-        reader = csv.DictReader(
-	    open(filepath, errors='ignore'),
-	    dialect='excel-tab')
+    def __init__(self, filepath, collection_pid, conf=CONF, spool=False):
+        self.filepath = filepath
+        self.spool = spool
         self.collection_pid = collection_pid
-        self.records = [r for r in reader]
         self.existing_pids = []
         self.conf = conf 
+        self.error_log = "{}.errors.log".format(filepath)
+        self.checkpoint = "{}.checkpoint".format(filepath)
+        self.errors = 0
+        self.existing = None
+        self.__existing_lock__ = threading.Lock()
+
+    def __check_existing__(self, title, creator):
+        """Method returns the PID of the object with an exact match on title,
+        using creator to choose between objects sharing a title. Uses the
+        index from _prefetch_existing, falling back to _check_existing if
+        the prefetch failed.
+
+        Args:
+            title: Title string
+            creator: Creator string
+        """
+        if self.existing is None:
+            return _check_existing(title, creator)
+        with self.__existing_lock__:
+            pids = self.existing.get(title, dict())
+            if len(pids) > 1 and creator:
+                pids = {pid: creators for pid, creators in pids.items()
+                        if creator in creators}
+            if len(pids) == 1:
+                return next(iter(pids))
+
+    def __records__(self):
+        """Method streams rows from the tab-delimited export"""
+        with open(self.filepath, errors='ignore') as fo:
+            reader = csv.DictReader(fo, dialect='excel-tab')
+            for row in reader:
+                yield row
+
+    def __completed__(self):
+        """Method returns the set of row numbers in the checkpoint file"""
+        completed = set()
+        if not os.path.exists(self.checkpoint):
+            return completed
+        with open(self.checkpoint) as fo:
+            for line in fo:
+                try:
+                    completed.add(json.loads(line)["row"])
+                except (ValueError, KeyError):
+                    # Skips a partial line from an interrupted write
+                    continue
+        return completed
 
     def __new_fedora_object__(self, label):
-        new_pid_result = requests.post(
-            "{}new?namespace={}".format(
-                self.conf.REST_URL,
-                "codu"),
-            auth=self.conf.FEDORA_AUTH) 
+        with REMOTE_LIMITS["fedora"]:
+            new_pid_result = FEDORA.post(
+                "{}new?namespace={}".format(
+                    self.conf.REST_URL,
+                    "codu"))
         if new_pid_result.status_code > 399:
-            return
+            raise ValueError("Failed to create a Fedora object for {}, "
+                             "HTTP error {}".format(
+                                 label, new_pid_result.status_code))
         new_pid = new_pid_result.text
         modify_obj_url = "{}{}?{}".format(
             self.conf.REST_URL,
@@ -142,33 +344,97 @@ class Harvester(object):
                 {"label": label,
                  "ownerID": CONF.FEDORA_AUTH[0],
                  "state": 'A'}))
-        repo_modify_obj_result = requests.put(
-            modify_obj_url,
-            auth=self.conf.FEDORA_AUTH)
+        with REMOTE_LIMITS["fedora"]:
+            repo_modify_obj_result = FEDORA.put(modify_obj_url)
+        _require(repo_modify_obj_result.status_code < 400,
+                 "set the label and state",
+                 new_pid)
+        if self.existing is not None:
+            # Later rows with the same title match this new object
+            with self.__existing_lock__:
+                self.existing.setdefault(label, dict())[new_pid] = set()
         return new_pid
        
 
-    def harvest(self):
+    def __report__(self, i, row, future):
+        """Method waits for a record's result, appending the row number and
+        its pid to the checkpoint or writing any exception to the error
+        log, and prints progress in record order. A record that returns no
+        pid is logged as a failure so a resumed harvest retries it."""
+        try:
+            pid = future.result()
+            if not pid:
+                raise ValueError("Row {} was not ingested, no PID".format(i))
+            self.__checkpoint__.write(
+                json.dumps({"row": i, "pid": pid}) + "\n")
+            self.__checkpoint__.flush()
+            os.fsync(self.__checkpoint__.fileno())
+        except Exception:
+            self.errors += 1
+            with open(self.error_log, "a") as fo:
+                fo.write("Row {}\t{}\n{}\n".format(
+                    i,
+                    row.get('Title', row.get('Thin Section ID')),
+                    traceback.format_exc()))
+        if not i%10 and i > 0:
+            print(".", end="", flush=True)
+        if not i%100:
+            print(" {} ".format(i), end="", flush=True)
+
+    def harvest(self, workers=1, limits=None, resume=False):
+        """Method streams and harvests every record, with workers > 1 records
+        are processed concurrently by a bounded thread pool and calls to each
+        remote are limited by REMOTE_LIMITS. Completed rows are checkpointed
+        so a resumed harvest skips them.
+
+        Args:
+            workers -- Number of records processed concurrently
+            limits -- Optional dict of contentdm, fedora and ri limits
+            resume -- Skip rows already in the checkpoint file
+        """
         start = datetime.datetime.utcnow()
         warnings.filterwarnings("ignore")
-        print("Starting {} Harvester at {} for {} records".format(
-            Harvester.__name__,
+        if limits is not None:
+            set_remote_limits(**limits)
+        self.errors = 0
+        completed = set()
+        if resume:
+            completed = self.__completed__()
+        self.existing = _prefetch_existing(self.collection_pid)
+        print("Starting {} Harvester at {} with {} workers, skipping {} completed".format(
+            self.__class__.__name__,
             start,
-            len(self.records)))  
-        for i, row in enumerate(self.records):
-            try:
-                self.__process_record__(row)
-            except:
-                print("Error {} with {}".format(sys.exc_info()[0], i))
-            if not i%10 and i > 0:
-                print(".", end="")
-            if not i%100:
-                print(" {} ".format(i), end="")
+            workers,
+            len(completed)))
+        total = 0
+        self.__checkpoint__ = open(self.checkpoint, "a" if resume else "w")
+        with self.__checkpoint__, ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for i, row in enumerate(self.__records__()):
+                if i in completed:
+                    continue
+                pending.append(
+                    (i, row, executor.submit(self.__process_record__, row)))
+                # Bounds the records in flight and reports in order
+                if len(pending) >= workers * 2:
+                    self.__report__(*pending.popleft())
+                total += 1
+            while len(pending) > 0:
+                self.__report__(*pending.popleft())
         end = datetime.datetime.utcnow()
-        print("Total {} finished at {} total = {} seconds".format(
-            i, 
+        print("Total {} finished at {} total = {} seconds, {} errors logged to {}".format(
+            total, 
             end, 
-            (end-start).seconds))     
+            (end-start).seconds,
+            self.errors,
+            self.error_log))
+        for method, counter in sorted(FEDORA.stats().items()):
+            print("Fedora {} calls={} errors={} avg={:.3f}s max={:.3f}s".format(
+                method,
+                counter["calls"],
+                counter["errors"],
+                counter["seconds"] / max(counter["calls"], 1),
+                counter["max"]))
 
 
 class GeologyThinSlices(Harvester):
@@ -285,26 +551,28 @@ class GeologyThinSlices(Harvester):
 
     def __process_record__(self, row):
         title = row.get("Thin Section ID")
-        existing_ = _check_existing(title, None)
+        existing_ = self.__check_existing__(title, None)
         if existing_ is not None:
             self.existing_pids.append(existing_)
         ref_url = row.get('Reference URL')
         filename = row.get('CONTENTdm file name')
         if filename.endswith('jpg'):
             # Skip processing record should card
-            return
+            return SKIPPED
         new_pid = self.__new_fedora_object__(title)
-        _add_rels_ext(
+        added = _add_rels_ext(
             new_pid,  
             self.collection_pid,
             "islandora:sp_large_image_cmodel")
+        _require(added, "add RELS-EXT", new_pid)
         ld_result = self.__geo_linked_data__(new_pid, row)
-        _add_datastream(
+        added = _add_datastream(
             new_pid,
             ld_result.get('graph-rdf'),
             "GEO_LD",
             "Geology Linked Data",
             "application/rdf+xml")
+        _require(added, "add GEO_LD datastream", new_pid)
         mods_xml = MODS_TEMPLATE.render(
             abstract=ld_result.get('abstract', None),
             names=ld_result.get('names', []),
@@ -315,18 +583,22 @@ class GeologyThinSlices(Harvester):
             date_captured=row.get('Year Collected', None),
             date_created=row.get('Date created'),
             title=title)
-        _add_datastream(
+        added = _add_datastream(
             new_pid,
             mods_xml,
             "MODS",
             "Metadata Object Description Schema",
             "text/xml")
+        _require(added, "add MODS datastream", new_pid)
         collection_frag = ref_url.split("collection/")[-1]
         page_collection = collection_frag.split("id/")[0]
         postcard_url = "{}{}/filename/{}".format(GET_FILE_URL, 
             collection_frag,
             filename)
-        postcard_result = requests.get(postcard_url)
+        postcard_result = _get_contentdm(postcard_url)
+        _require(postcard_result.status_code < 400,
+                 "get the pages from {}".format(postcard_url),
+                 new_pid)
         raw_postcard = postcard_result.content
         postcard = etree.XML(raw_postcard)
         pages = postcard.findall("page")
@@ -343,18 +615,16 @@ class GeologyThinSlices(Harvester):
                 page_collection,
                 page_id,
                 page_img)
-            raw_request = requests.get(file_url)
-            if raw_request.status_code > 399:
-                print("Failed to get {}".format(file_url))
-                continue
-            raw_file = raw_request.content
-            _add_datastream(
+            added = _transfer_datastream(
+                file_url,
                 new_pid, 
-                raw_file, 
                 obj_id,
                 "{}-{}".format(title.text,
                               page_img), 
-                mimetypes.guess_type(page_img)[0])
+                mimetypes.guess_type(page_img)[0],
+                self.spool)
+            _require(added, "add {} datastream".format(obj_id), new_pid)
+        return new_pid
  
               
 
@@ -365,12 +635,12 @@ class GypsyAmes(Harvester):
         title = row.get('Title')
         creator=row.get("Creator")
         ref_url = row.get('Reference URL')
-        existing_ = _check_existing(title, creator)
+        existing_ = self.__check_existing__(title, creator)
         if existing_ is not None:
             self.existing_pids.append(
                 {"ref-url": ref_url,
                  "pid": existing_})
-            return
+            return existing_
         new_pid = self.__new_fedora_object__(title)
         collection_frag = ref_url.split("collection/")[-1]
         filename = row.get('CONTENTdm file name')
@@ -381,27 +651,31 @@ class GypsyAmes(Harvester):
             department="Theatre and Dance Department",
             title=title,
             type_of_resource=row.get('Type'))
-        _add_datastream(
+        added = _add_datastream(
             new_pid,
             mods_xml,
             "MODS",
             "Metadata Object Description Schema",
             "text/xml")
+        _require(added, "add MODS datastream", new_pid)
         file_url = "{}{}/filename/{}".format(GET_FILE_URL, 
             collection_frag,
             filename)
-        raw_file = requests.get(file_url).content
-        _add_datastream(
+        added = _transfer_datastream(
+            file_url,
             new_pid, 
-            raw_file, 
             "OBJ",
             "{}{}".format(row.get('Local Identifier'),
                           filename), 
-            mimetypes.guess_type(file_url)[0])
-        _add_rels_ext(
+            mimetypes.guess_type(file_url)[0],
+            self.spool)
+        _require(added, "add OBJ datastream", new_pid)
+        added = _add_rels_ext(
             new_pid,  
             self.collection_pid,
             "islandora:sp_large_image_cmodel")
+        _require(added, "add RELS-EXT", new_pid)
+        return new_pid
 
    
  
@@ -634,12 +908,13 @@ class IDEASMerged(Harvester):
         # First create new fedora obj
         new_pid = self.__new_fedora_object__(title)
         # Add MODS
-        _add_datastream(
+        added = _add_datastream(
             new_pid,
             mods_xml,
             "MODS",
             "Metadata Object Description Schema",
             "text/xml")
+        _require(added, "add MODS datastream", new_pid)
         content_model = "islandora:sp_large_image_cmodel"
         if type_of_resource.startswith('sound recording'):
             content_model = "islandora:sp-audioCModel"
@@ -648,24 +923,57 @@ class IDEASMerged(Harvester):
         if type_of_resource.startswith("text"):
             content_model = "islandora:sp_document"
         # Add RELS-EXT datastream
-        _add_rels_ext(
+        added = _add_rels_ext(
             new_pid,  
             self.collection_pid,
             "islandora:sp_large_image_cmodel")
+        _require(added, "add RELS-EXT", new_pid)
         filename = row.get("CONTENTdm file name")
         collection_frag = ref_url.split("collection/")[-1]
         file_url = "{}{}/filename/{}".format(GET_FILE_URL, 
             collection_frag,
             filename)
-        file_result = requests.get(file_url)
-        raw_file = file_result.content
         # Add Object
-        _add_datastream(
+        added = _transfer_datastream(
+            file_url,
             new_pid, 
-            raw_file, 
             "OBJ",
             filename,               
-            mimetypes.guess_type(file_url)[0])
+            mimetypes.guess_type(file_url)[0],
+            self.spool)
+        _require(added, "add OBJ datastream", new_pid)
+        return new_pid
+
+HARVESTERS = {
+    "geology": GeologyThinSlices,
+    "gypsy-ames": GypsyAmes,
+    "ideas": IDEASMerged
+}
+
+@click.command()
+@click.argument("filepath")
+@click.argument("collection_pid")
+@click.option("--harvester", type=click.Choice(sorted(HARVESTERS)),
+              default="ideas", help="Harvester for the CONTENTdm export")
+@click.option("--workers", default=1, help="Records processed concurrently")
+@click.option("--contentdm-limit", default=4,
+              help="Concurrent CONTENTdm downloads")
+@click.option("--fedora-limit", default=4, help="Concurrent Fedora calls")
+@click.option("--ri-limit", default=2,
+              help="Concurrent resource index queries")
+@click.option("--resume", is_flag=True,
+              help="Skip rows completed by a previous run")
+@click.option("--spool", is_flag=True,
+              help="Spool CONTENTdm files to disk before uploading")
+def harvest(filepath, collection_pid, harvester, workers, contentdm_limit,
+            fedora_limit, ri_limit, resume, spool):
+    """Harvests a tab-delimited CONTENTdm export into COLLECTION_PID"""
+    HARVESTERS[harvester](filepath, collection_pid, spool=spool).harvest(
+        workers=workers,
+        limits={"contentdm": contentdm_limit,
+                "fedora": fedora_limit,
+                "ri": ri_limit},
+        resume=resume)
 
 if __name__ == "__main__":
     harvest()
@@ -2,8 +2,11 @@
 
 __author__ = "Jeremy Nelson, Sarah Bogard"
 
+import base64
 import click
+import json
 import os
+import re
 import requests
 import sys
 
@@ -11,8 +14,12 @@ from collections import OrderedDict
 from copy import deepcopy
 from flask import abort
 from elasticsearch import Elasticsearch
+from elasticsearch.serializer import JSONSerializer
 from elasticsearch_dsl import Search, Q, A
 import xml.etree.ElementTree as etree
+from .cache import LRUCache
+from .fedora import FedoraClient
+from .metrics import timed
 
 etree.register_namespace("mods", "http://www.loc.gov/mods/v3")
 
@@ -74,45 +81,242 @@ if not REPO_SEARCH:
     # 9200 and 9300
     REPO_SEARCH = Elasticsearch()
 
-def browse(pid, from_=0):
+
+class RawJSONSerializer(JSONSerializer):
+    """Serializer that returns Elasticsearch response bodies as the JSON
+    string from the transport instead of decoding them"""
+
+    def loads(self, s):
+        return s
+
+# Client for the JSON endpoints' pass-through path, search results are
+# returned as JSON strings
+RAW_SEARCH = Elasticsearch(REPO_SEARCH.transport.hosts,
+                           serializer=RawJSONSerializer())
+
+# Shared pooled client for anonymous Fedora REST calls from the views
+FEDORA = FedoraClient(
+    rest_url=getattr(CONF, "REST_URL", None),
+    ri_url=getattr(CONF, "RI_URL", None),
+    timeout=getattr(CONF, "FEDORA_TIMEOUT", (3.05, 30)),
+    retries=getattr(CONF, "FEDORA_RETRIES", 3),
+    pool_size=getattr(CONF, "FEDORA_POOL_SIZE", 10))
+
+# Bounded cache of pid to titlePrincipal used by the title_principal filter
+TITLE_CACHE = LRUCache(
+    max_entries=getattr(CONF, "TITLE_CACHE_SIZE", 2048),
+    ttl=getattr(CONF, "TITLE_CACHE_TTL", 3600))
+
+# Sort used for cursor paging, pid breaks ties between equal titles
+CURSOR_SORT = ["titleInfo.title", "pid"]
+
+# Named _source projections, list returns only the fields rendered by
+# results.html and discovery.js for each hit
+SOURCE_PROFILES = {
+    "list": {"includes": ["pid",
+                          "titlePrincipal",
+                          "titleInfo.title",
+                          "abstract",
+                          "creator",
+                          "dateCreated"]},
+    "detail": {"excludes": ["lastModifiedDate",
+                            "parent",
+                            "suggest",
+                            "titleInfo"]},
+    "title": {"includes": ["pid", "titlePrincipal"]}
+}
+
+def source_profile(profile):
+    """Function returns the _source includes and excludes for a profile
+    name, None returns the full document
+
+    Args:
+        profile -- list, detail, title or None
+    """
+    if profile is None:
+        return True
+    return SOURCE_PROFILES[profile]
+
+def encode_cursor(sort_values):
+    """Function takes the sort values of the last hit on a page and returns
+    an opaque next-page token
+
+    Args:
+        sort_values -- List of sort values from a hit
+    """
+    raw_cursor = json.dumps(sort_values).encode()
+    return base64.urlsafe_b64encode(raw_cursor).decode()
+
+def decode_cursor(token):
+    """Function takes a next-page token and returns the search_after sort
+    values, aborts with a 400 error if the token is invalid
+
+    Args:
+        token -- Token from encode_cursor
+    """
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (ValueError, TypeError):
+        abort(400)
+    if not isinstance(sort_values, list):
+        abort(400)
+    return sort_values
+
+def _next_cursor(results, size):
+    """Internal function returns the next-page token for a search result
+    or None if this was the last page
+
+    Args:
+        results -- dict of search results sorted by CURSOR_SORT
+        size -- page size
+    """
+    hits = results['hits']['hits']
+    if len(hits) < int(size) or not 'sort' in hits[-1]:
+        return
+    return encode_cursor(hits[-1]['sort'])
+
+def _apply_cursor(search, after, size):
+    """Internal function sorts a Search by CURSOR_SORT and starts it after
+    the after token, if after is an empty string starts at the first page
+
+    Args:
+        search -- elasticsearch_dsl Search
+        after -- Next-page token
+        size -- page size
+    """
+    search = search.extra(size=int(size), from_=0).sort(*CURSOR_SORT)
+    if after:
+        search = search.extra(search_after=decode_cursor(after))
+    return search
+
+def _raw_search(body):
+    """Internal function runs a repository search with RAW_SEARCH and
+    returns the response body as the JSON string from the transport
+
+    Args:
+        body -- Search request body
+    """
+    return RAW_SEARCH.search(index="repository", body=body)
+
+def _raw_results(body, size, after):
+    """Internal function returns a raw search response as JSON bytes, only
+    decoding it to add the next-page token when paging with a cursor
+
+    Args:
+        body -- JSON string from _raw_search
+        size -- page size
+        after -- Next-page token or None
+    """
+    if after is None:
+        return body.encode()
+    output = json.loads(body)
+    output['next'] = _next_cursor(output, size)
+    return json.dumps(output).encode()
+
+# Kinds of completions in the suggest field and an in-process cache of the
+# hottest prefixes
+SUGGEST_KINDS = ("title", "creator", "subject")
+SUGGEST_MAX_PREFIX = 50
+SUGGEST_CACHE = LRUCache(
+    max_entries=getattr(CONF, "SUGGEST_CACHE_SIZE", 4096),
+    ttl=getattr(CONF, "SUGGEST_CACHE_TTL", 600))
+
+# Caches the index generation for GENERATION_CHECK seconds
+GENERATION_CHECK = 30
+GENERATION_CACHE = LRUCache(max_entries=1, ttl=GENERATION_CHECK)
+
+@timed("es")
+def index_generation():
+    """Function returns a string identifying the concrete index behind the
+    repository alias and its creation date, result caches include it in
+    their keys so a reindex or alias swap invalidates them"""
+    generation = GENERATION_CACHE.get("repository")
+    if generation is None:
+        indices = REPO_SEARCH.indices.get('repository')
+        generation = ";".join(sorted(
+            "{}:{}".format(name, info['settings']['index']['creation_date'])
+            for name, info in indices.items()))
+        GENERATION_CACHE.set("repository", generation)
+    return generation
+
+@timed("es")
+def browse(pid, from_=0, after=None, profile="list", raw=False):
     """Function takes a pid and runs query to retrieve all of it's children
-    pids
+    pids along with the collection's facets in a single Elasticsearch
+    request. The facet aggregations are nested under a filter aggregation
+    scoped to the pid and then unpacked into the top-level aggregations.
 
     Args:
 		pid: PID of Fedora Object
+		from_: From location, ignored if after is not None
+		after: Next-page token for cursor paging
+		profile: Name of the SOURCE_PROFILES projection of each hit
+		raw: Return the results as JSON bytes
     """
 
     # DU DEV
     #pid="codu:root"
     # .filter("term", parent=pid) \
     search = Search(using=REPO_SEARCH, index="repository") \
-             .params(size=50, from_=from_) \
-             .sort("titleInfo.title")
-    results = search.execute()
+             .extra(size=50, from_=int(from_)) \
+             .sort(*CURSOR_SORT) \
+             .extra(_source=source_profile(profile))
+    if after is not None:
+        search = _apply_cursor(search, after, 50)
+    collection = search.aggs.bucket(
+        "collection",
+        A("filter", Q("term", inCollections=pid)))
+    _add_facets(collection, year_field="publicationYear")
+    if raw:
+        # Decoded once to unpack the facets, plain json is still much
+        # cheaper than elasticsearch_dsl's Response and to_dict()
+        output = json.loads(_raw_search(search.to_dict()))
+    else:
+        output = search.execute().to_dict()
+    facets = output.get("aggregations", {}).get("collection", {})
+    facets.pop("doc_count", None)
+    output['aggregations'] = facets
+    output['next'] = _next_cursor(output, 50)
+    if raw:
+        return json.dumps(output).encode()
+    return output
 
+def sort_aggregations(aggregations):
+    """Function takes a dictionary of aggregations and returns an
+    OrderedDict sorted by facet name with the empty facets removed.
 
+    Args:
+        aggregations -- dictionary of aggregations from a search result
 
-    # DU DEV
-    print("DU: Browse search results: ", results)
-    output = results.to_dict()
-    search = Search(using=REPO_SEARCH, index="repository") \
-             .filter("term", inCollections=pid) \
-             .params(size=0)
-    search.aggs.bucket("Format", A("terms", field="typeOfResource"))
-    search.aggs.bucket("Geographic", A("terms", field="subject.geographic"))
-    search.aggs.bucket("Genres", A("terms", field="genre"))
-    search.aggs.bucket("Languages", A("terms", field="language.keyword"))
-    search.aggs.bucket("Publication Year", A("terms", field="publicationYear"))
-    search.aggs.bucket("Temporal (Time)", A("terms", field="subject.temporal"))
-    search.aggs.bucket("Topic", A("terms", field="subject.topic"))
-    facets = search.execute()
-
-    print("DU: Browse search facet results: ", facets)
-
-    output['aggregations'] = facets.to_dict()["aggregations"]
+    Returns:
+        OrderedDict of the non-empty aggregations
+    """
+    output = OrderedDict()
+    for key in sorted(aggregations):
+        aggregation = aggregations[key]
+        if len(aggregation.get('buckets', [])) > 0:
+            output[key] = aggregation
     return output
 
-def filter_query(facet, facet_value, query=None, size=25, from_=0):
+def _add_facets(bucket, year_field="dateCreated"):
+    """Internal function adds the facet term aggregations shared by browse
+    and search to an elasticsearch_dsl aggregation container
+
+    Args:
+        bucket -- Search.aggs or a parent aggregation
+        year_field -- Field used for the Publication Year facet
+    """
+    bucket.bucket("Format", A("terms", field="typeOfResource"))
+    bucket.bucket("Geographic", A("terms", field="subject.geographic"))
+    bucket.bucket("Genres", A("terms", field="genre"))
+    bucket.bucket("Languages", A("terms", field="language.keyword"))
+    bucket.bucket("Publication Year", A("terms", field=year_field))
+    bucket.bucket("Temporal (Time)", A("terms", field="subject.temporal"))
+    bucket.bucket("Topic", A("terms", field="subject.topic"))
+
+@timed("es")
+def filter_query(facet, facet_value, query=None, size=25, from_=0, after=None,
+                 profile="list", raw=False):
     """Function takes a facet, facet_value, and query string, and constructs
     filter for Elastic search.
 
@@ -122,11 +326,15 @@ def filter_query(facet, facet_value, query=None, size=25, from_=0):
 		query: Query, if blank searches entire index
 		size: size of result set, defaults to 25
 		from_: From location, used for infinite browse
+		after: Next-page token, if not None pages with search_after
+		profile: Name of the SOURCE_PROFILES projection of each hit
+		raw: Return the results as JSON bytes
     """
     dsl = {
-        "size": size,
-	"from": from_,
+        "size": int(size),
+	"from": int(from_),
         "aggs": AGGS_DSL['aggs'],
+        "_source": source_profile(profile)
     }
     field_name = AGGS_DSL["aggs"][facet]["terms"]["field"] 
     if query is not None:
@@ -154,11 +362,22 @@ def filter_query(facet, facet_value, query=None, size=25, from_=0):
                 field_name : facet_value
             }
         }
+    if after is not None:
+        dsl["from"] = 0
+        dsl["sort"] = CURSOR_SORT
+        if after:
+            dsl["search_after"] = decode_cursor(after)
+    if raw:
+        return _raw_results(_raw_search(dsl), size, after)
     results = REPO_SEARCH.search(body=dsl, index="repository")
+    if after is not None:
+        results['next'] = _next_cursor(results, size)
     return results
 
 
-def specific_search(query, type_of, size=25, from_=0, pid=None):
+@timed("es")
+def specific_search(query, type_of, size=25, from_=0, pid=None, after=None,
+                    profile="list", raw=False):
     """Function takes a query and fields list and runs a search on those
     specific fields.
     
@@ -166,17 +385,14 @@ def specific_search(query, type_of, size=25, from_=0, pid=None):
         query: query terms to search on
         type_of: Type of query, choices should be creator, title, subject,
                  and number
+        after: Next-page token, if not None pages with search_after
+        profile: Name of the SOURCE_PROFILES projection of each hit
+        raw: Return the results as JSON bytes
 
     Returns:
-	    A dict of the search results
+	    A dict of the search results or JSON bytes if raw is True
     """
 
-    #DU: Specific search test
-    print("DU: Specific search pid: ", pid)
-    print("DU: Specific search query: ", query)
-    print("DU: Specific search type_of: ", type_of)
-
-
     search = Search(using=REPO_SEARCH, index="repository")
 
     if type_of.startswith("creator"):
@@ -191,27 +407,27 @@ def specific_search(query, type_of, size=25, from_=0, pid=None):
                      Q("match_phrase", **{"subject.temporal": query}))
     elif query is None and pid is not None:
         search = search.filter("term", parent=pid) \
-                 .params(size=50, from_=from_) \
+                 .extra(size=50, from_=from_) \
                  .sort("titleInfo.title")
 
 
     else:
         search = search.query(
             Q("query_string", query=query, default_operator="AND"))
-    search.params(size=size, from_=from_)
-    search.aggs.bucket("Format", A("terms", field="typeOfResource"))
-    search.aggs.bucket("Geographic", A("terms", field="subject.geographic"))
-    search.aggs.bucket("Genres", A("terms", field="genre"))
-    search.aggs.bucket("Languages", A("terms", field="language.keyword"))
-    search.aggs.bucket("Publication Year", A("terms", field="dateCreated"))
-    search.aggs.bucket("Temporal (Time)", A("terms", field="subject.temporal"))
-    search.aggs.bucket("Topic", A("terms", field="subject.topic"))
+    search = search.extra(size=int(size), from_=int(from_)) \
+             .extra(_source=source_profile(profile))
+    if after is not None:
+        search = _apply_cursor(search, after, size)
+    _add_facets(search.aggs)
+    if raw:
+        return _raw_results(_raw_search(search.to_dict()), size, after)
     results = search.execute()
-    
-    print("Specific search facet results: ", results)
-
-    return results.to_dict()
+    output = results.to_dict()
+    if after is not None:
+        output['next'] = _next_cursor(output, size)
+    return output
 
+@timed("es")
 def get_aggregations(pid=None):
     """Function takes an optional pid and returns the aggregations
     scoped by the pid, if pid is None, runs aggregation on full ES
@@ -228,22 +444,20 @@ def get_aggregations(pid=None):
     if pid is not None:
         dsl["query"] = {"term": { "inCollections": pid } }
     results = REPO_SEARCH.search(index="repository", body=dsl)['aggregations']
-    output = OrderedDict()
-    for key in sorted(results):
-        aggregation = results[key]
-        if len(aggregation.get('buckets')) > 0:
-            output[key] = aggregation
-    return output
+    return sort_aggregations(results)
         
-def get_detail(pid):
+@timed("es")
+def get_detail(pid, profile="detail"):
     """Function takes a pid and returns the detailed dictionary from 
     the search results.
 
     Args:
         pid -- PID of Fedora Object
+        profile -- Name of the SOURCE_PROFILES projection
     """
     search = Search(using=REPO_SEARCH, index="repository") \
-             .filter("term", pid=pid)
+             .filter("term", pid=pid) \
+             .extra(_source=source_profile(profile))
     result = search.execute()
     if len(result) < 1:
         # Raise 404 error because PID not found
@@ -251,6 +465,7 @@ def get_detail(pid):
     return result.to_dict()
  
 
+@timed("es")
 def get_pid(es_id):
     """Function takes Elastic search id and returns the object's
     pid.
@@ -261,18 +476,102 @@ def get_pid(es_id):
     es_doc = REPO_SEARCH.get_source(id=es_id, index="repository")
     return es_doc.get("pid")
 
+def suggest(prefix, size=5):
+    """Function takes a typed prefix and returns up to size completions of
+    each kind from the suggest completion field, served from SUGGEST_CACHE
+    for repeated prefixes
+
+    Args:
+        prefix -- Typed prefix
+        size -- Maximum completions of each kind
+
+    Returns:
+        dict of title, creator and subject lists, titles include the pid
+    """
+    prefix = re.sub(r"\s+", " ", prefix or "").strip().lower()
+    prefix = prefix[:SUGGEST_MAX_PREFIX]
+    if len(prefix) < 1:
+        return {kind: [] for kind in SUGGEST_KINDS}
+    cache_key = "{}|{}".format(size, prefix)
+    output = SUGGEST_CACHE.get(cache_key)
+    if output is None:
+        output = _complete(prefix, size)
+        SUGGEST_CACHE.set(cache_key, output)
+    return output
+
+@timed("es")
+def _complete(prefix, size):
+    """Internal function runs one completion suggester per kind in a single
+    request and returns the de-duplicated completions
+
+    Args:
+        prefix -- Normalized prefix
+        size -- Maximum completions of each kind
+    """
+    body = {"_source": source_profile("title"), "suggest": {}}
+    for kind in SUGGEST_KINDS:
+        # Asks for extra options as several documents share creators,
+        # subjects and sometimes titles
+        body["suggest"][kind] = {
+            "prefix": prefix,
+            "completion": {"field": "suggest",
+                           "size": size * 3,
+                           "contexts": {"kind": [kind]}}}
+    result = REPO_SEARCH.search(index="repository", body=body)
+    output = dict()
+    for kind in SUGGEST_KINDS:
+        completions, seen = [], set()
+        for suggestion in result.get("suggest", {}).get(kind, []):
+            for option in suggestion.get("options", []):
+                text = option.get("text")
+                if text in seen:
+                    continue
+                seen.add(text)
+                completion = {"text": text}
+                if kind == "title":
+                    completion["pid"] = option.get("_source", {}).get("pid")
+                completions.append(completion)
+        output[kind] = completions[:size]
+    return output
+
 def get_title(pid):
     """Function takes a pid and returns the titlePrincipal as a string
 
     Args:
         pid -- PID of Fedora Object
     """
-    result = REPO_SEARCH.search(body={"query": {"term": {"pid": pid }},
-			                         "_source": ["titlePrincipal"]},
+    return get_titles([pid]).get(pid, "Home")
+
+@timed("es")
+def get_titles(pids):
+    """Function takes a list of pids and returns a dictionary of each pid's
+    titlePrincipal. Any pids not in TITLE_CACHE are resolved with a single
+    terms query and added to the cache, unknown pids map to "Home".
+
+    Args:
+        pids -- List of Fedora Object PIDs
+    """
+    output, missing = dict(), []
+    for pid in pids:
+        title = TITLE_CACHE.get(pid)
+        if title is None:
+            missing.append(pid)
+        else:
+            output[pid] = title
+    if len(missing) < 1:
+        return output
+    missing = list(set(missing))
+    result = REPO_SEARCH.search(body={"query": {"terms": {"pid": missing}},
+                                      "_source": source_profile("title"),
+                                      "size": len(missing)},
                                 index='repository')
-    if result.get('hits').get('total') == 1:
-        return result['hits']['hits'][0]['_source']['titlePrincipal']
-    return "Home"
+    for hit in result['hits']['hits']:
+        source = hit['_source']
+        output[source['pid']] = source.get('titlePrincipal', "Home")
+    for pid in missing:
+        title = output.setdefault(pid, "Home")
+        TITLE_CACHE.set(pid, title)
+    return output
 
 if __name__ == "__main__":
     print()
@@ -0,0 +1,476 @@
+"""Module provides small in-process caches used by the search functions and
+the Aristotle views"""
+__author__ = "Jeremy Nelson"
+
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Expiry time header of a DiskCache file, 0 never expires
+EXPIRES = struct.Struct("!d")
+
+class LRUCache(object):
+    """Thread-safe least recently used cache with an optional time-to-live
+    for each entry and an optional bound on the total size of the values.
+
+    Args:
+        max_entries -- Maximum number of entries kept in the cache
+        ttl -- Seconds an entry stays fresh, None never expires
+        max_bytes -- Maximum total of sizeof(value), None is unbounded
+        sizeof -- Function returning the size of a value in bytes
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None,
+                 sizeof=len):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.__entries__ = OrderedDict()
+        self.__lock__ = threading.Lock()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.__entries__)
+
+    def __remove__(self, key):
+        value, expires, size = self.__entries__.pop(key)
+        self.size -= size
+
+    def clear(self):
+        with self.__lock__:
+            self.__entries__.clear()
+            self.size = 0
+
+    def delete(self, key):
+        with self.__lock__:
+            if key in self.__entries__:
+                self.__remove__(key)
+
+    def get(self, key, default=None):
+        """Method returns the value for key, moving it to the most
+        recently used position, or default if missing or expired"""
+        with self.__lock__:
+            entry = self.__entries__.get(key)
+            if entry is None:
+                return default
+            value, expires, size = entry
+            if expires is not None and expires < time.time():
+                self.__remove__(key)
+                return default
+            self.__entries__.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, size=None):
+        """Method adds or replaces a value and evicts the least recently
+        used entries beyond max_entries or max_bytes. Values larger than
+        max_bytes are not cached."""
+        ttl = ttl or self.ttl
+        expires = time.time() + ttl if ttl else None
+        if size is None:
+            size = self.sizeof(value) if self.max_bytes else 0
+        with self.__lock__:
+            if key in self.__entries__:
+                self.__remove__(key)
+            if self.max_bytes and size > self.max_bytes:
+                return
+            self.__entries__[key] = (value, expires, size)
+            self.size += size
+            while len(self.__entries__) > self.max_entries or\
+                  (self.max_bytes and self.size > self.max_bytes):
+                self.__remove__(next(iter(self.__entries__)))
+
+
+class DiskCache(object):
+    """On-disk cache sharded into subdirectories, each shard has its own
+    lock and an in-memory LRU index of its files so a write evicts the
+    oldest files without scanning the directory. Other workers write to the
+    same directory, a background thread in each process rebuilds one
+    shard's index from the directory at a time, every shard once per rescan
+    seconds, so the bound covers every worker's files.
+
+    Args:
+        directory -- Root directory of the cache
+        max_bytes -- Total size of the cached files
+        shards -- Number of shard subdirectories
+        rescan -- Seconds between reconciling a shard with the directory
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, shards=16,
+                 rescan=30):
+        self.directory = directory
+        self.shards = shards
+        self.shard_bytes = max_bytes // shards
+        self.rescan = rescan
+        self.__indexes__ = [None] * shards
+        self.__sizes__ = [0] * shards
+        # Names set, read or deleted while a shard is being scanned
+        self.__touched__ = [None] * shards
+        self.__locks__ = [threading.Lock() for shard in range(shards)]
+        self.__reconciler__ = {"pid": None}
+        self.__reconciler_lock__ = threading.Lock()
+
+    def __locate__(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        shard = int(name[:4], 16) % self.shards
+        return shard, name, os.path.join(self.directory, str(shard), name)
+
+    def __scan__(self, shard):
+        """Method returns a shard's (name, size) files, oldest first"""
+        shard_dir = os.path.join(self.directory, str(shard))
+        os.makedirs(shard_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(shard_dir):
+            if entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Removed by another worker while scanning
+                continue
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        return [(name, size) for mtime, name, size in entries]
+
+    def _shard_index(self, shard):
+        """Method returns a shard's LRU index, loading it from the directory
+        on first use, the caller holds the shard's lock"""
+        index = self.__indexes__[shard]
+        if index is None:
+            index = OrderedDict(self.__scan__(shard))
+            self.__indexes__[shard] = index
+            self.__sizes__[shard] = sum(index.values())
+        return index
+
+    def __touch__(self, shard, name, size):
+        touched = self.__touched__[shard]
+        if touched is not None:
+            touched[name] = size
+            touched.move_to_end(name)
+
+    def __discard__(self, shard, name):
+        index = self._shard_index(shard)
+        self.__sizes__[shard] -= index.pop(name, 0)
+        self.__touch__(shard, name, None)
+        try:
+            os.remove(os.path.join(self.directory, str(shard), name))
+        except OSError:
+            pass
+
+    def __evict__(self, shard):
+        index = self._shard_index(shard)
+        while self.__sizes__[shard] > self.shard_bytes and len(index) > 1:
+            self.__discard__(shard, next(iter(index)))
+
+    def reconcile(self, shard):
+        """Method rebuilds a shard's index from the directory, keeping the
+        recency of the names this process used during the scan, and evicts
+        any files over the bound. The directory is scanned without holding
+        the shard's lock.
+
+        Args:
+            shard -- Shard number
+        """
+        with self.__locks__[shard]:
+            self.__touched__[shard] = OrderedDict()
+        try:
+            scanned = self.__scan__(shard)
+        finally:
+            with self.__locks__[shard]:
+                touched = self.__touched__[shard]
+                self.__touched__[shard] = None
+                index = OrderedDict(scanned)
+                for name, size in touched.items():
+                    if size is None:
+                        index.pop(name, None)
+                    elif size >= 0:
+                        index[name] = size
+                    if name in index:
+                        index.move_to_end(name)
+                self.__indexes__[shard] = index
+                self.__sizes__[shard] = sum(index.values())
+                self.__evict__(shard)
+
+    def start_reconciler(self):
+        """Method starts the background reconcile thread once per process,
+        it is started on first use so each forked uwsgi worker has its own"""
+        if self.__reconciler__["pid"] == os.getpid():
+            return
+        with self.__reconciler_lock__:
+            if self.__reconciler__["pid"] == os.getpid():
+                return
+            self.__reconciler__["pid"] = os.getpid()
+
+            def reconcile_loop():
+                shard = 0
+                while 1:
+                    time.sleep(self.rescan / self.shards)
+                    try:
+                        self.reconcile(shard)
+                    except Exception as error:
+                        print("Failed to reconcile {} shard {}: {}".format(
+                            self.directory, shard, error))
+                    shard = (shard + 1) % self.shards
+
+            threading.Thread(target=reconcile_loop,
+                             name="disk-cache-reconciler",
+                             daemon=True).start()
+
+    def delete(self, key):
+        shard, name, path = self.__locate__(key)
+        with self.__locks__[shard]:
+            self.__discard__(shard, name)
+
+    def get_pickled(self, key):
+        """Method returns the pickled value for key or None if it is missing
+        or expired"""
+        self.start_reconciler()
+        shard, name, path = self.__locate__(key)
+        try:
+            with open(path, "rb") as fo:
+                expires, = EXPIRES.unpack(fo.read(EXPIRES.size))
+                data = fo.read()
+        except (OSError, struct.error):
+            return None
+        with self.__locks__[shard]:
+            if expires and expires < time.time():
+                self.__discard__(shard, name)
+                return None
+            index = self._shard_index(shard)
+            if name in index:
+                index.move_to_end(name)
+            # -1 keeps the scanned size and only records the use
+            self.__touch__(shard, name, index.get(name, -1))
+        return data
+
+    def get(self, key):
+        data = self.get_pickled(key)
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return None
+
+    def set_pickled(self, key, data, timeout=None):
+        """Method stores an already pickled value, the file is the expiry
+        time followed by data
+
+        Args:
+            key -- Cache key
+            data -- Bytes from pickle.dumps
+            timeout -- Seconds the value stays cached, None never expires
+        """
+        self.start_reconciler()
+        shard, name, path = self.__locate__(key)
+        expires = time.time() + timeout if timeout else 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        with os.fdopen(fd, "wb") as fo:
+            fo.write(EXPIRES.pack(expires))
+            fo.write(data)
+        os.replace(tmp_path, path)
+        size = EXPIRES.size + len(data)
+        with self.__locks__[shard]:
+            index = self._shard_index(shard)
+            self.__sizes__[shard] -= index.pop(name, 0)
+            index[name] = size
+            self.__sizes__[shard] += size
+            self.__touch__(shard, name, size)
+            self.__evict__(shard)
+        return True
+
+    def set(self, key, value, timeout=None):
+        return self.set_pickled(
+            key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), timeout)
+
+    def clear(self):
+        for shard in range(self.shards):
+            with self.__locks__[shard]:
+                index = self._shard_index(shard)
+                index.update(self.__scan__(shard))
+                for name in list(index):
+                    self.__discard__(shard, name)
+
+
+class RedisCache(object):
+    """Cache backed by a Redis compatible server so every uwsgi worker
+    shares entries, requires the optional redis package
+
+    Args:
+        url -- Redis URL i.e. redis://localhost:6379/0
+        prefix -- Prefix added to every key
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="digitalcc:"):
+        if redis is None:
+            raise ImportError("redis package is required for a Redis cache")
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def get_pickled(self, key):
+        return self.client.get(self.prefix + key)
+
+    def get(self, key):
+        raw_value = self.get_pickled(key)
+        if raw_value is None:
+            return None
+        return pickle.loads(raw_value)
+
+    def set_pickled(self, key, data, timeout=None):
+        return self.client.set(self.prefix + key, data, ex=timeout or None)
+
+    def set(self, key, value, timeout=None):
+        return self.set_pickled(
+            key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), timeout)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+
+class TieredCache(object):
+    """Cache with an in-process LRU tier bounded by bytes in front of a
+    shared DiskCache or RedisCache backend, with the get, set and delete
+    methods of werkzeug's caches and hit and miss statistics. Values are
+    pickled once, the same bytes size the memory tier and are stored by
+    the backend.
+
+    Args:
+        backend -- DiskCache, RedisCache or None for memory only
+        memory_bytes -- Bound on the pickled size of the memory tier
+        memory_ttl -- Seconds an entry stays in the memory tier, keeps
+                      workers from serving values another worker replaced
+        default_timeout -- Seconds an entry stays cached when set is
+                           called without a timeout, 0 never expires
+    """
+
+    def __init__(self,
+                 backend=None,
+                 memory_bytes=64 * 1024 * 1024,
+                 memory_ttl=60,
+                 default_timeout=300):
+        self.backend = backend
+        self.memory = LRUCache(max_entries=100000, max_bytes=memory_bytes)
+        self.memory_ttl = memory_ttl
+        self.default_timeout = default_timeout
+        self.__counts__ = {"memory_hits": 0, "backend_hits": 0,
+                           "misses": 0, "sets": 0}
+        self.__lock__ = threading.Lock()
+
+    def __count__(self, name):
+        with self.__lock__:
+            self.__counts__[name] += 1
+
+    def get(self, key, memory=True):
+        """Method returns the value for key or None, memory=False skips the
+        memory tier for values the caller keeps in its own cache"""
+        memory = memory or self.backend is None
+        value = self.memory.get(key) if memory else None
+        if value is not None:
+            self.__count__("memory_hits")
+            return value
+        data = None
+        if self.backend is not None:
+            data = self.backend.get_pickled(key)
+        if data is not None:
+            try:
+                value = pickle.loads(data)
+            except Exception:
+                value = None
+        if value is None:
+            self.__count__("misses")
+            return None
+        self.__count__("backend_hits")
+        if memory:
+            self.memory.set(key, value, ttl=self.memory_ttl, size=len(data))
+        return value
+
+    def set(self, key, value, timeout=None, memory=True):
+        """Method stores value for timeout seconds, memory=False only
+        stores it in the backend"""
+        memory = memory or self.backend is None
+        if timeout is None:
+            timeout = self.default_timeout
+        self.__count__("sets")
+        memory_ttl = min(timeout, self.memory_ttl) if timeout else\
+                     self.memory_ttl
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if memory:
+            self.memory.set(key, value, ttl=memory_ttl, size=len(data))
+        else:
+            self.memory.delete(key)
+        if self.backend is not None:
+            self.backend.set_pickled(key, data, timeout)
+        return True
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.backend is not None:
+            self.backend.delete(key)
+        return True
+
+    def clear(self):
+        self.memory.clear()
+        if self.backend is not None:
+            self.backend.clear()
+        return True
+
+    def stats(self):
+        """Method returns the hit and miss counts, the hit ratio and the
+        size of the memory tier"""
+        with self.__lock__:
+            output = dict(self.__counts__)
+        lookups = output["memory_hits"] + output["backend_hits"] +\
+                  output["misses"]
+        output["hit_ratio"] = (output["memory_hits"] + output["backend_hits"])\
+                              / max(lookups, 1)
+        output["memory_bytes"] = self.memory.size
+        output["memory_entries"] = len(self.memory)
+        return output
+
+
+def _setting(conf, name, default):
+    if isinstance(conf, dict):
+        return conf.get(name, default)
+    return getattr(conf, name, default)
+
+def create_cache(conf, default_dir):
+    """Function builds the TieredCache configured by the instance conf's
+    CACHE_TYPE ("disk", "redis" or "memory"), CACHE_DIR, CACHE_DISK_BYTES,
+    CACHE_MEMORY_BYTES, CACHE_REDIS_URL and CACHE_DEFAULT_TIMEOUT settings
+
+    Args:
+        conf -- Instance conf module or dict
+        default_dir -- Cache directory used if CACHE_DIR is not set
+    """
+    cache_type = _setting(conf, "CACHE_TYPE", "disk")
+    backend = None
+    if cache_type == "disk":
+        backend = DiskCache(
+            _setting(conf, "CACHE_DIR", default_dir),
+            max_bytes=_setting(conf, "CACHE_DISK_BYTES", 512 * 1024 * 1024))
+    elif cache_type == "redis":
+        backend = RedisCache(
+            _setting(conf, "CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    return TieredCache(
+        backend=backend,
+        memory_bytes=_setting(conf, "CACHE_MEMORY_BYTES", 64 * 1024 * 1024),
+        default_timeout=_setting(conf, "CACHE_DEFAULT_TIMEOUT", 300))
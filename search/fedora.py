@@ -0,0 +1,114 @@
+"""Module provides a shared Fedora REST client with keep-alive connection
+pooling, timeouts, bounded retries and per-call latency counters and
+histograms"""
+__author__ = "Jeremy Nelson"
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from .metrics import timer
+
+
+class FedoraClient(object):
+    """Wraps a requests Session for calls to Fedora's REST API and resource
+    index. Only idempotent methods are retried.
+
+    Args:
+        rest_url -- Base URL of Fedora's REST API
+        ri_url -- URL of Fedora's resource index
+        auth -- Optional (user, password) tuple used for every call
+        timeout -- Connect and read timeout in seconds
+        retries -- Maximum number of retries for failed connections or
+                   502, 503 and 504 responses
+        pool_size -- Number of keep-alive connections kept per host
+    """
+
+    def __init__(self,
+                 rest_url=None,
+                 ri_url=None,
+                 auth=None,
+                 timeout=(3.05, 30),
+                 retries=3,
+                 pool_size=10):
+        self.rest_url = rest_url
+        self.ri_url = ri_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=retries,
+                              backoff_factor=0.3,
+                              status_forcelist=(502, 503, 504),
+                              raise_on_status=False))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.__counters__ = dict()
+        self.__lock__ = threading.Lock()
+
+    def __record__(self, method, seconds, failed):
+        with self.__lock__:
+            counter = self.__counters__.setdefault(
+                method,
+                {"calls": 0, "errors": 0, "seconds": 0.0, "max": 0.0})
+            counter["calls"] += 1
+            counter["seconds"] += seconds
+            counter["max"] = max(counter["max"], seconds)
+            if failed:
+                counter["errors"] += 1
+
+    def request(self, method, url, **kwargs):
+        """Method sends a request through the pooled session and records
+        its latency, the timeout defaults to the client's timeout
+
+        Args:
+            method -- HTTP method
+            url -- Fedora URL
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        failed = True
+        try:
+            with timer("fedora", method):
+                result = self.session.request(method, url, **kwargs)
+            failed = result.status_code > 399
+            return result
+        finally:
+            self.__record__(method, time.perf_counter() - start, failed)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def datastream_url(self, pid, dsid):
+        """Method returns the REST URL for a datastream's content"""
+        return "{}{}/datastreams/{}/content".format(self.rest_url, pid, dsid)
+
+    def sparql(self, query):
+        """Method runs a SPARQL query against the resource index and
+        returns the response
+
+        Args:
+            query -- SPARQL query string
+        """
+        return self.post(self.ri_url,
+                         data={"type": "tuples",
+                               "lang": "sparql",
+                               "format": "json",
+                               "query": query})
+
+    def stats(self):
+        """Method returns a copy of the latency counters by HTTP method"""
+        with self.__lock__:
+            return {method: dict(counter)
+                    for method, counter in self.__counters__.items()}
@@ -0,0 +1,321 @@
+"""Module builds repository documents from Fedora objects and writes them
+to Elasticsearch with the bulk API"""
+__author__ = "Jeremy Nelson, Sarah Bogard"
+
+import datetime
+import re
+import threading
+import xml.etree.ElementTree as etree
+
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch.helpers import bulk
+
+from . import CONF, REPO_SEARCH, SUGGEST_KINDS
+from .fedora import FedoraClient
+
+NS = {
+    "fedora": "http://www.fedora.info/definitions/1/0/access/",
+    "fedora-model": "info:fedora/fedora-system:def/model#",
+    "mods": "http://www.loc.gov/mods/v3",
+    "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+    "rels-ext": "info:fedora/fedora-system:def/relations-external#"
+}
+RDF_RESOURCE = "{{{}}}resource".format(NS["rdf"])
+YEAR_RE = re.compile(r"(\d{4})")
+
+# Completion field used by search.suggest, each input is tagged with its
+# kind so titles, creators and subjects are suggested separately
+SUGGEST_MAPPING = {
+    "type": "completion",
+    "analyzer": "standard",
+    "contexts": [{"name": "kind", "type": "category"}]
+}
+
+
+class IndexerError(Exception):
+    """Raised when Fedora or Elasticsearch fail during indexing"""
+
+    def __init__(self, title, message):
+        super(IndexerError, self).__init__(title, message)
+        self.title = title
+        self.message = message
+
+    def __str__(self):
+        return "{}\n{}".format(self.title, self.message)
+
+
+def _texts(element, path):
+    """Internal function returns the stripped text of every element matching
+    path that has text"""
+    return [row.text.strip() for row in element.findall(path, NS)
+            if row.text and len(row.text.strip()) > 0]
+
+def _first(element, path):
+    values = _texts(element, path)
+    if len(values) > 0:
+        return values[0]
+
+def suggest_inputs(doc):
+    """Function returns the completion inputs for a repository document's
+    titles, creators and subject terms
+
+    Args:
+        doc -- Repository document
+    """
+    subject = doc.get("subject", {})
+    values = {
+        "title": doc.get("titleInfo", {}).get("title", []),
+        "creator": doc.get("creator", []),
+        "subject": subject.get("topic", []) + subject.get("geographic", [])
+    }
+    inputs = []
+    for kind in SUGGEST_KINDS:
+        terms = sorted(set(value for value in values[kind] if value))
+        if len(terms) > 0:
+            inputs.append({"input": terms, "contexts": {"kind": [kind]}})
+    return inputs
+
+
+class Indexer(object):
+    """Builds repository documents for Fedora objects and indexes them in
+    batches with the Elasticsearch bulk API.
+
+    Args:
+        elastic -- Elasticsearch client, defaults to REPO_SEARCH
+        fedora -- FedoraClient, defaults to a client authenticated with
+                  the instance's FEDORA_AUTH
+        index -- Name of the index or alias documents are written to
+        workers -- Number of Fedora objects fetched concurrently
+        batch_size -- Documents sent in each bulk request
+        refresh_interval -- Index refresh interval used during a load, the
+                            index is reset to 1s and refreshed afterwards
+    """
+
+    def __init__(self,
+                 elastic=REPO_SEARCH,
+                 fedora=None,
+                 index="repository",
+                 workers=4,
+                 batch_size=500,
+                 refresh_interval="30s"):
+        self.elastic = elastic
+        self.fedora = fedora or FedoraClient(
+            rest_url=getattr(CONF, "REST_URL", None),
+            ri_url=getattr(CONF, "RI_URL", None),
+            auth=getattr(CONF, "FEDORA_AUTH", None),
+            pool_size=max(workers, 10))
+        self.index = index
+        self.doc_type = getattr(CONF, "INDEX_DOC_TYPE", "mods")
+        self.workers = workers
+        self.batch_size = batch_size
+        self.refresh_interval = refresh_interval
+        self.__parents__ = dict()
+        self.__lock__ = threading.Lock()
+        self.__suggest_mapped__ = False
+
+    def _fedora_get(self, pid, path=""):
+        """Method returns Fedora's response for a pid's URL plus path,
+        named so it does not define the descriptor protocol's __get__"""
+        url = "{}{}{}".format(self.fedora.rest_url, pid, path)
+        result = self.fedora.get(url)
+        if result.status_code > 399:
+            raise IndexerError(
+                "Indexer HTTP error {} for {}".format(result.status_code, pid),
+                url)
+        return result
+
+    def __collections__(self, rels_ext):
+        return [row.get(RDF_RESOURCE).split("/")[-1]
+                for row in rels_ext.iter(
+                    "{{{}}}isMemberOfCollection".format(NS["rels-ext"]))]
+
+    def __ancestors__(self, pid, seen=None):
+        """Method returns a pid's collections from the root to the nearest,
+        memoizing each collection's parents"""
+        seen = seen or set([pid])
+        with self.__lock__:
+            parents = self.__parents__.get(pid)
+        if parents is None:
+            rels_ext = etree.XML(
+                self._fedora_get(pid, "/datastreams/RELS-EXT/content").content)
+            parents = self.__collections__(rels_ext)
+            with self.__lock__:
+                self.__parents__[pid] = parents
+        ancestors = []
+        for parent in parents:
+            if parent in seen:
+                continue
+            seen.add(parent)
+            for row in self.__ancestors__(parent, seen) + [parent]:
+                if not row in ancestors:
+                    ancestors.append(row)
+        return ancestors
+
+    def __mods__(self, mods, doc):
+        """Method adds the MODS fields used by the discovery views"""
+        titles = _texts(mods, "mods:titleInfo/mods:title")
+        doc["titleInfo"] = {"title": titles}
+        doc["titlePrincipal"] = titles[0] if len(titles) > 0 else None
+        doc["creator"], doc["contributor"] = [], []
+        for name in mods.findall("mods:name", NS):
+            full_name = " ".join(_texts(name, "mods:namePart"))
+            if len(full_name) < 1:
+                continue
+            roles = [role.lower() for role in _texts(
+                name, "mods:role/mods:roleTerm")]
+            if len(roles) < 1 or "creator" in roles:
+                doc["creator"].append(full_name)
+            else:
+                doc["contributor"].append(full_name)
+        doc["dateCreated"] = _first(mods, "mods:originInfo/mods:dateCreated")
+        doc["dateIssued"] = _first(mods, "mods:originInfo/mods:dateIssued")
+        doc["place"] = _first(mods, "mods:originInfo/mods:place/mods:placeTerm")
+        doc["publisher"] = _first(mods, "mods:originInfo/mods:publisher")
+        year = YEAR_RE.search(doc["dateIssued"] or doc["dateCreated"] or "")
+        doc["publicationYear"] = year.group(1) if year else None
+        doc["language"] = _texts(mods, "mods:language/mods:languageTerm")
+        doc["typeOfResource"] = _first(mods, "mods:typeOfResource")
+        doc["genre"] = _texts(mods, "mods:genre")
+        doc["subject"] = {
+            "topic": _texts(mods, "mods:subject/mods:topic"),
+            "geographic": _texts(mods, "mods:subject/mods:geographic"),
+            "temporal": _texts(mods, "mods:subject/mods:temporal")
+        }
+        doc["abstract"] = _texts(mods, "mods:abstract")
+        doc["note"], doc["adminNote"] = [], []
+        for note in mods.findall("mods:note", NS):
+            if not note.text:
+                continue
+            if note.get("type") == "admin":
+                doc["adminNote"].append(note.text.strip())
+            else:
+                doc["note"].append(note.text.strip())
+        doc["useAndReproduction"] = _first(mods, "mods:accessCondition")
+        doc["digitalOrigin"] = _first(
+            mods, "mods:physicalDescription/mods:digitalOrigin")
+        doc["extent"] = _first(mods, "mods:physicalDescription/mods:extent")
+
+    def build_document(self, pid):
+        """Method fetches a Fedora object's profile, datastream list,
+        RELS-EXT and MODS and returns the repository document
+
+        Args:
+            pid -- PID of Fedora Object
+        """
+        profile = etree.XML(self._fedora_get(pid, "?format=xml").content)
+        doc = {
+            "pid": pid,
+            "lastModifiedDate": _first(profile, "fedora:objLastModDate"),
+            "content_models": [model.split("/")[-1] for model in _texts(
+                profile, "fedora:objModels/fedora:model")]
+        }
+        datastreams = etree.XML(
+            self._fedora_get(pid, "/datastreams?format=xml").content)
+        doc["datastreams"] = [
+            {"pid": pid,
+             "dsid": row.get("dsid"),
+             "label": row.get("label"),
+             "mimeType": row.get("mimeType")}
+            for row in datastreams.findall("fedora:datastream", NS)]
+        dsids = [row["dsid"] for row in doc["datastreams"]]
+        if "RELS-EXT" in dsids:
+            rels_ext = etree.XML(
+                self._fedora_get(pid, "/datastreams/RELS-EXT/content").content)
+            parents = self.__collections__(rels_ext)
+            with self.__lock__:
+                self.__parents__[pid] = parents
+            doc["parent"] = parents
+            doc["inCollections"] = self.__ancestors__(pid)
+        if "MODS" in dsids:
+            mods = etree.XML(
+                self._fedora_get(pid, "/datastreams/MODS/content").content)
+            self.__mods__(mods, doc)
+        else:
+            doc["titlePrincipal"] = _first(profile, "fedora:objLabel")
+            doc["titleInfo"] = {"title": [doc["titlePrincipal"]]}
+        doc["suggest"] = suggest_inputs(doc)
+        return doc
+
+    def put_suggest_mapping(self):
+        """Method adds the suggest completion field to the index's mapping
+        once per Indexer, existing documents get suggestions when they are
+        next indexed"""
+        if self.__suggest_mapped__:
+            return
+        self.elastic.indices.put_mapping(
+            index=self.index,
+            doc_type=self.doc_type,
+            body={"properties": {"suggest": SUGGEST_MAPPING}})
+        self.__suggest_mapped__ = True
+
+    def __actions__(self, pids, report):
+        """Method yields bulk index actions, building documents with the
+        fetch worker pool"""
+        def build(pid):
+            try:
+                return pid, self.build_document(pid)
+            except (IndexerError, etree.ParseError) as error:
+                print("Failed to build {}: {}".format(pid, error))
+                return pid, None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for pid, doc in executor.map(build, pids):
+                if doc is None:
+                    report["errors"] += 1
+                    continue
+                yield {"_index": self.index,
+                       "_type": self.doc_type,
+                       "_id": pid,
+                       "_source": doc}
+
+    def index_pids(self, pids):
+        """Method indexes a list of pids with bulk requests of batch_size
+        documents, relaxing the refresh interval during the load
+
+        Args:
+            pids -- List or iterator of PIDs
+
+        Returns:
+            dict report with indexed, errors, seconds and docs_per_second
+        """
+        start = datetime.datetime.utcnow()
+        report = {"indexed": 0, "errors": 0}
+        self.put_suggest_mapping()
+        self.elastic.indices.put_settings(
+            index=self.index,
+            body={"index": {"refresh_interval": self.refresh_interval}})
+        try:
+            indexed, errors = bulk(
+                self.elastic,
+                self.__actions__(pids, report),
+                chunk_size=self.batch_size,
+                raise_on_error=False)
+            report["indexed"] = indexed
+            report["errors"] += len(errors)
+        finally:
+            self.elastic.indices.put_settings(
+                index=self.index,
+                body={"index": {"refresh_interval": "1s"}})
+            self.elastic.indices.refresh(index=self.index)
+        seconds = (datetime.datetime.utcnow() - start).total_seconds()
+        report["seconds"] = seconds
+        report["docs_per_second"] = report["indexed"] / max(seconds, 0.001)
+        print("Indexed {indexed} documents with {errors} errors in "
+              "{seconds:.1f} seconds, {docs_per_second:.1f} docs/sec".format(
+                  **report))
+        return report
+
+    def index_pid(self, pid):
+        """Method indexes a single pid
+
+        Args:
+            pid -- PID of Fedora Object
+        """
+        doc = self.build_document(pid)
+        self.put_suggest_mapping()
+        self.elastic.index(
+            index=self.index,
+            doc_type=self.doc_type,
+            id=pid,
+            body=doc)
+        return doc
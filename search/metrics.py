@@ -0,0 +1,220 @@
+"""Module times calls to Elasticsearch, Fedora and template rendering for
+the Server-Timing header and aggregates them into Prometheus-style latency
+histograms for the /metrics endpoint"""
+__author__ = "Jeremy Nelson"
+
+import functools
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+PREFIX = "digitalcc"
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Thread-safe latency histogram with fixed buckets
+
+    Args:
+        buckets -- Sorted upper bounds of the buckets in seconds
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.__lock__ = threading.Lock()
+
+    def observe(self, seconds):
+        with self.__lock__:
+            self.count += 1
+            self.sum += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def snapshot(self):
+        """Method returns a (cumulative bucket counts, sum, count) tuple"""
+        with self.__lock__:
+            cumulative, total = [], 0
+            for count in self.counts:
+                total += count
+                cumulative.append(total)
+            return cumulative, self.sum, self.count
+
+
+class Registry(object):
+    """Holds a Histogram for each metric name and label set
+
+    Args:
+        descriptions -- dict of metric name to HELP text
+    """
+
+    def __init__(self, descriptions):
+        self.descriptions = descriptions
+        self.__histograms__ = OrderedDict()
+        self.__lock__ = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        """Method records seconds in the histogram for name and labels"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.__histograms__.get(key)
+        if histogram is None:
+            with self.__lock__:
+                histogram = self.__histograms__.setdefault(key, Histogram())
+        histogram.observe(seconds)
+
+    def exposition(self):
+        """Method returns the histograms in the Prometheus text format"""
+        lines = []
+        with self.__lock__:
+            histograms = list(self.__histograms__.items())
+        for name in self.descriptions:
+            metric = "{}_{}_seconds".format(PREFIX, name)
+            lines.append("# HELP {} {}".format(
+                metric, self.descriptions[name]))
+            lines.append("# TYPE {} histogram".format(metric))
+            for (row_name, labels), histogram in histograms:
+                if row_name != name:
+                    continue
+                cumulative, total, count = histogram.snapshot()
+                for bound, bucket_count in zip(histogram.buckets, cumulative):
+                    lines.append(format_metric(
+                        metric + "_bucket", bucket_count,
+                        labels + (("le", str(bound)),)))
+                lines.append(format_metric(
+                    metric + "_bucket", count, labels + (("le", "+Inf"),)))
+                lines.append(format_metric(metric + "_sum", total, labels))
+                lines.append(format_metric(metric + "_count", count, labels))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry(OrderedDict([
+    ("request", "Time to the response headers by view"),
+    ("backend", "Time spent in Elasticsearch, Fedora and template "
+                "rendering by operation")]))
+
+
+class Timings(object):
+    """Per-request totals of the seconds spent in each backend, shared by
+    the threads working on the request"""
+
+    def __init__(self):
+        self.totals = OrderedDict()
+        self.__lock__ = threading.Lock()
+
+    def add(self, backend, seconds):
+        with self.__lock__:
+            self.totals[backend] = self.totals.get(backend, 0.0) + seconds
+
+    def server_timing(self, total=None):
+        """Method returns the value of a Server-Timing header
+
+        Args:
+            total -- Optional seconds for the whole request
+        """
+        with self.__lock__:
+            entries = list(self.totals.items())
+        if total is not None:
+            entries.append(("total", total))
+        return ", ".join("{};dur={:.1f}".format(backend, seconds * 1000)
+                         for backend, seconds in entries)
+
+
+__local__ = threading.local()
+
+def format_metric(name, value, labels=()):
+    """Function returns a line of the Prometheus text format
+
+    Args:
+        name -- Metric name
+        value -- Number
+        labels -- Sequence of (label, value) tuples
+    """
+    if len(labels) < 1:
+        return "{} {}".format(name, value)
+    return "{}{{{}}} {}".format(
+        name,
+        ",".join('{}="{}"'.format(
+            label, str(label_value).replace('\\', '\\\\').replace('"', '\\"'))
+            for label, label_value in labels),
+        value)
+
+def start_timings():
+    """Function starts collecting backend timings for the current thread's
+    request and returns the Timings"""
+    __local__.timings = Timings()
+    return __local__.timings
+
+def stop_timings():
+    """Function stops collecting and returns the current thread's Timings
+    or None"""
+    timings = getattr(__local__, "timings", None)
+    __local__.timings = None
+    return timings
+
+def with_timings(function):
+    """Function wraps function so that, when run on another thread, its
+    backend calls are added to the calling request's Timings
+
+    Args:
+        function -- Function submitted to a thread pool
+    """
+    timings = getattr(__local__, "timings", None)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        __local__.timings = timings
+        try:
+            return function(*args, **kwargs)
+        finally:
+            __local__.timings = None
+    return wrapper
+
+@contextmanager
+def timer(backend, operation):
+    """Context manager records the time spent in a backend operation, nested
+    calls to the same backend are only counted once in the request's
+    Timings
+
+    Args:
+        backend -- Backend name i.e. es, fedora or render
+        operation -- Operation name used as the histogram label
+    """
+    active = getattr(__local__, "active", None)
+    if active is None:
+        active = __local__.active = set()
+    outermost = not backend in active
+    active.add(backend)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        REGISTRY.observe("backend", seconds,
+                         backend=backend, operation=operation)
+        if outermost:
+            active.discard(backend)
+            timings = getattr(__local__, "timings", None)
+            if timings is not None:
+                timings.add(backend, seconds)
+
+def timed(backend, operation=None):
+    """Decorator times every call of a function with timer
+
+    Args:
+        backend -- Backend name
+        operation -- Operation name, defaults to the function's name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(backend, operation or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,43 +1,141 @@
 #!/usr/bin/env python3
-"""Module polls repository and indexes any new Fedora objects"""
+"""Module polls repository and indexes any new or modified Fedora objects
+since the last run's lastModifiedDate watermark"""
 __author__ = "Jeremy Nelson"
 
+import click
 import datetime
-import requests
-from . import CONF, REPO_SEARCH
+import os
+from . import BASE_DIR, CONF, REPO_SEARCH
+from .fedora import FedoraClient
 from .indexer import Indexer, IndexerError
 
-# SPARQL Constants
-NEWEST_100_SPARQL = """SELECT DISTINCT ?s ?date
-WHERE { ?s <fedora-model:createdDate> ?date . }
-ORDER BY DESC(?date)
-LIMIT 100"""
+FEDORA = FedoraClient(
+    rest_url=getattr(CONF, "REST_URL", None),
+    ri_url=getattr(CONF, "RI_URL", None),
+    auth=getattr(CONF, "FEDORA_AUTH", None))
+
+# File storing the lastModifiedDate of the newest change indexed
+WATERMARK_PATH = getattr(
+    CONF,
+    "POLL_WATERMARK",
+    os.path.join(BASE_DIR, "instance", "poll-watermark.txt"))
+EPOCH = "1970-01-01T00:00:00.000Z"
+PAGE_SIZE = 500
+
+# SPARQL Constants, pages are keyed on (?modified, ?s) rather than OFFSET
+# so objects modified while paging are neither skipped nor repeated
+CHANGED_SPARQL = """SELECT DISTINCT ?s ?modified
+WHERE {{
+  ?s <fedora-view:lastModifiedDate> ?modified .
+  FILTER ({0})
+}}
+ORDER BY ?modified ?s
+LIMIT {1}"""
+SINCE_FILTER = '?modified >= "{0}"^^<http://www.w3.org/2001/XMLSchema#dateTime>'
+AFTER_FILTER = '?modified > "{0}"^^<http://www.w3.org/2001/XMLSchema#dateTime>'\
+    ' || (?modified = "{0}"^^<http://www.w3.org/2001/XMLSchema#dateTime>'\
+    ' && STR(?s) > "{1}")'
 
 # Functions
-def check_index_new():
-    """Function retrieves the newest 100 PIDS from Fedora, checks index
-	for existence, and indexes PID if not found."""
-    result = requests.post(
-        CONF.get('RI_URL'),
-        data={"type": "tuples",
-              "lang": "sparql",
-              "format": "json",
-              "query": NEWEST_100_SPARQL},
-        auth=CONF.get('FEDORA_AUTH'))
-	if result.status_code > 399:
-        raise IndexerError(
-            "check_index_new() HTTP error {}".format(result.status_code),
-            "Could not newest PIDS from repository\n{}".format(result.text))
-    indexer = Indexer()
-    for row in result.json().get('results'):
-        pid = row.get('s').split("/")[-1]
-        dsl = {
-            "query": {
-                "term": {"pid": pid}
-            }
-        }
-        exists_result = REPO_SEARCH.search(body=dsl, index='repository')
-        if exists_result['hits']['count'] > 0:
-            continue
-	    # Now run indexer
-        indexer.index_pid(pid)
+def get_watermark():
+    """Function returns the stored lastModifiedDate watermark or the epoch
+    if the index has never been synced"""
+    if not os.path.exists(WATERMARK_PATH):
+        return EPOCH
+    with open(WATERMARK_PATH) as fo:
+        return fo.read().strip() or EPOCH
+
+def set_watermark(modified):
+    """Function durably replaces the stored watermark
+
+    Args:
+        modified -- lastModifiedDate string
+    """
+    tmp_path = "{}.tmp".format(WATERMARK_PATH)
+    with open(tmp_path, "w") as fo:
+        fo.write(modified)
+        fo.flush()
+        os.fsync(fo.fileno())
+    os.replace(tmp_path, WATERMARK_PATH)
+
+def indexed_modified(pids, index='repository'):
+    """Function takes a list of pids and returns a dictionary of the
+    lastModifiedDate of each pid already in the index with a single terms
+    query
+
+    Args:
+        pids -- List of PIDs
+        index -- Index or alias to check
+    """
+    result = REPO_SEARCH.search(
+        index=index,
+        body={"query": {"terms": {"pid": pids}},
+              "_source": ["pid", "lastModifiedDate"],
+              "size": len(pids)})
+    return {hit['_source']['pid']: hit['_source'].get('lastModifiedDate')
+            for hit in result['hits']['hits']}
+
+def sync_index(since=None, page_size=PAGE_SIZE, index='repository',
+               watermark=True):
+    """Function pages through every Fedora object modified since the
+    watermark, checks the index in bulk and indexes only the new or changed
+    objects. The watermark advances after each page until a page has
+    errors, so the next run retries the failed objects.
+
+    Args:
+        since -- Optional lastModifiedDate, defaults to the watermark
+        page_size -- Changed objects retrieved per SPARQL query
+        index -- Index or alias to update
+        watermark -- Store the watermark, False leaves it unchanged
+
+    Returns:
+        Dictionary of the number of objects indexed and errors
+    """
+    since = since or get_watermark()
+    indexer = Indexer(index=index)
+    report = {"indexed": 0, "errors": 0}
+    where = SINCE_FILTER.format(since)
+    while 1:
+        result = FEDORA.sparql(CHANGED_SPARQL.format(where, page_size))
+        if result.status_code > 399:
+            raise IndexerError(
+                "sync_index() HTTP error {}".format(result.status_code),
+                "Could not retrieve changed PIDS from repository\n{}".format(
+                    result.text))
+        rows = result.json().get('results')
+        if len(rows) < 1:
+            break
+        changes = {row.get('s').split("/")[-1]: row.get('modified')
+                   for row in rows}
+        indexed = indexed_modified(list(changes), index)
+        # Skips objects already indexed at this modification
+        changed = [pid for pid, modified in changes.items()
+                   if indexed.get(pid) != modified]
+        if len(changed) > 0:
+            page_report = indexer.index_pids(changed)
+            report["indexed"] += page_report["indexed"]
+            report["errors"] += page_report["errors"]
+        if watermark and report["errors"] < 1:
+            set_watermark(rows[-1].get('modified'))
+        if len(rows) < page_size:
+            break
+        where = AFTER_FILTER.format(
+            rows[-1].get('modified'),
+            rows[-1].get('s').replace('\\', '\\\\').replace('"', '\\"'))
+    return report
+
+@click.command()
+@click.option("--since", default=None,
+              help="lastModifiedDate to sync from instead of the watermark")
+def sync(since):
+    """Indexes Fedora objects modified since the last sync"""
+    start = datetime.datetime.utcnow()
+    report = sync_index(since)
+    print("Indexed {} changed objects with {} errors in {} seconds".format(
+        report["indexed"],
+        report["errors"],
+        (datetime.datetime.utcnow() - start).seconds))
+
+if __name__ == "__main__":
+    sync()
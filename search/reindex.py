@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Module rebuilds the repository index into a fresh timestamped index and
+atomically moves the repository alias to it when the load is finished
+without errors, a concrete repository index is replaced by the alias"""
+__author__ = "Jeremy Nelson"
+
+import click
+import datetime
+
+from . import AGGS_DSL, CONF, REPO_SEARCH
+from .fedora import FedoraClient
+from .indexer import Indexer, IndexerError
+from .poll import sync_index
+
+ALIAS = "repository"
+PAGE_SIZE = 5000
+
+# Pages are keyed on the last subject rather than OFFSET so every object
+# is listed once even if objects are added while paging
+ALL_OBJECTS_SPARQL = """SELECT DISTINCT ?s
+WHERE {{
+  ?s <fedora-model:hasModel> <info:fedora/fedora-system:FedoraObject-3.0> .
+  FILTER (STR(?s) > "{1}")
+}}
+ORDER BY ?s
+LIMIT {0}"""
+
+def all_pids(fedora, page_size=PAGE_SIZE):
+    """Function pages through the resource index and yields every object's
+    PID
+
+    Args:
+        fedora -- FedoraClient
+        page_size -- PIDs retrieved per SPARQL query
+    """
+    last = ""
+    while 1:
+        result = fedora.sparql(ALL_OBJECTS_SPARQL.format(page_size, last))
+        if result.status_code > 399:
+            raise IndexerError(
+                "all_pids() HTTP error {}".format(result.status_code),
+                result.text)
+        rows = result.json().get('results')
+        for row in rows:
+            pid = row.get('s').split("/")[-1]
+            if not pid.startswith("fedora-system"):
+                yield pid
+        if len(rows) < page_size:
+            break
+        last = rows[-1].get('s').replace('\\', '\\\\').replace('"', '\\"')
+
+def alias_indices(elastic=REPO_SEARCH, alias=ALIAS):
+    """Function returns the concrete indices behind alias, an empty list if
+    the alias does not exist
+
+    Args:
+        elastic -- Elasticsearch client
+        alias -- Alias name
+    """
+    if not elastic.indices.exists_alias(name=alias):
+        return []
+    return list(elastic.indices.get_alias(name=alias).keys())
+
+def create_index(name, elastic=REPO_SEARCH, alias=ALIAS):
+    """Function creates a load-optimized index with no replicas and no
+    refresh, copying the mappings of the index currently behind alias
+
+    Args:
+        name -- Name of the new index
+        elastic -- Elasticsearch client
+        alias -- Alias or index whose mappings are copied
+    """
+    body = {"settings": {"index": {"number_of_replicas": 0,
+                                   "refresh_interval": "-1"}}}
+    if elastic.indices.exists(index=alias):
+        mappings = elastic.indices.get_mapping(index=alias)
+        body["mappings"] = list(mappings.values())[0]["mappings"]
+    elastic.indices.create(index=name, body=body)
+
+def warm_index(name, elastic=REPO_SEARCH):
+    """Function runs the home page's browse sort and aggregations against
+    the new index so the first user requests after the swap are not cold
+
+    Args:
+        name -- Name of the index
+        elastic -- Elasticsearch client
+    """
+    elastic.search(index=name,
+                   body={"sort": ["titleInfo.title"], "size": 50})
+    elastic.search(index=name,
+                   body={"size": 0, "aggs": AGGS_DSL["aggs"]})
+
+def swap_alias(name, elastic=REPO_SEARCH, alias=ALIAS):
+    """Function atomically points alias at name and removes it from the
+    previous indices. If alias is still a concrete index it is deleted in
+    the same request, an alias cannot share an index's name.
+
+    Args:
+        name -- Name of the new index
+        elastic -- Elasticsearch client
+        alias -- Alias name
+
+    Returns:
+        List of the indices previously behind alias
+    """
+    previous = alias_indices(elastic, alias)
+    actions = [{"remove": {"index": index, "alias": alias}}
+               for index in previous]
+    if len(previous) < 1 and elastic.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": name, "alias": alias}})
+    elastic.indices.update_aliases(body={"actions": actions})
+    return previous
+
+@click.command()
+@click.option("--workers", default=8, help="Fedora objects fetched concurrently")
+@click.option("--batch-size", default=500, help="Documents per bulk request")
+@click.option("--replicas", default=1,
+              help="Replicas restored after the load")
+@click.option("--delete-old", is_flag=True,
+              help="Delete the indices previously behind the alias")
+def reindex(workers, batch_size, replicas, delete_old):
+    """Rebuilds the repository index and swaps the alias with no downtime"""
+    start = datetime.datetime.utcnow()
+    name = "{}-{}".format(ALIAS, start.strftime("%Y%m%d%H%M%S"))
+    if REPO_SEARCH.indices.exists(index=ALIAS) and\
+       len(alias_indices(REPO_SEARCH, ALIAS)) < 1:
+        print("{0} is a concrete index, it will be deleted and replaced by "
+              "a {0} alias when the load finishes".format(ALIAS))
+    create_index(name)
+    fedora = FedoraClient(
+        rest_url=getattr(CONF, "REST_URL", None),
+        ri_url=getattr(CONF, "RI_URL", None),
+        auth=getattr(CONF, "FEDORA_AUTH", None),
+        pool_size=max(workers, 10))
+    indexer = Indexer(fedora=fedora,
+                      index=name,
+                      workers=workers,
+                      batch_size=batch_size,
+                      refresh_interval="-1")
+    report = indexer.index_pids(all_pids(fedora))
+    # Catches objects modified in Fedora while the load was running
+    catch_up = sync_index(since=start.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                          index=name,
+                          watermark=False)
+    if report["errors"] > 0 or catch_up["errors"] > 0 or\
+       report["indexed"] < 1:
+        raise click.ClickException(
+            "Indexed {} objects with {} errors into {}, {} was not "
+            "swapped".format(report["indexed"] + catch_up["indexed"],
+                             report["errors"] + catch_up["errors"],
+                             name,
+                             ALIAS))
+    REPO_SEARCH.indices.put_settings(
+        index=name,
+        body={"index": {"number_of_replicas": replicas,
+                        "refresh_interval": "1s"}})
+    REPO_SEARCH.indices.forcemerge(index=name, max_num_segments=1)
+    REPO_SEARCH.cluster.health(index=name, wait_for_status="yellow")
+    warm_index(name)
+    previous = swap_alias(name)
+    print("{} now points to {}, previously {}".format(ALIAS, name, previous))
+    if delete_old:
+        for index in previous:
+            REPO_SEARCH.indices.delete(index=index)
+    print("Reindex finished in {} seconds".format(
+        (datetime.datetime.utcnow() - start).seconds))
+
+if __name__ == "__main__":
+    reindex()
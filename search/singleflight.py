@@ -0,0 +1,112 @@
+"""Module coalesces concurrent recomputations of the same cache key so only
+one thread per process and one uwsgi worker per host runs the search while
+the others wait for its result or are served the stale value"""
+__author__ = "Jeremy Nelson"
+
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SingleFlight(object):
+    """Runs at most one computation per key at a time. Threads in a process
+    share a threading.Event and workers on the host share flock()ed lock
+    files. Keys are hashed onto a fixed number of lock files, a follower
+    that collides with an unrelated key only waits and then computes.
+
+    Args:
+        directory -- Directory of the lock files, shared by the workers
+        wait -- Seconds a follower waits for the leader before computing
+        stripes -- Number of lock files
+    """
+
+    def __init__(self, directory, wait=10.0, stripes=1024):
+        self.directory = directory
+        self.wait = wait
+        self.stripes = stripes
+        self.__flights__ = dict()
+        self.__lock__ = threading.Lock()
+
+    def __lock_path__(self, key):
+        stripe = int(hashlib.sha1(key.encode()).hexdigest()[:8], 16) %\
+                 self.stripes
+        return os.path.join(self.directory, "{}.lock".format(stripe))
+
+    def __wait_for_lock__(self, fd):
+        """Method polls the lock file until the leader releases it, returns
+        False if it is still held after wait seconds"""
+        deadline = time.time() + self.wait
+        while time.time() < deadline:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                time.sleep(0.05)
+                continue
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return True
+        return False
+
+    def __lead__(self, key, compute, load, stale):
+        """Method computes as this host's leader for key, or follows the
+        worker that holds the key's lock file"""
+        if fcntl is None:
+            return compute()
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self.__lock_path__(key), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                if stale is not None:
+                    return stale
+                if self.__wait_for_lock__(fd):
+                    value = load()
+                    if value is not None:
+                        return value
+                return compute()
+            try:
+                # Another worker may have finished just before the lock
+                value = load()
+                if value is not None:
+                    return value
+                return compute()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def run(self, key, compute, load, stale=None):
+        """Method returns the value for key, computing it only if no other
+        thread or worker is already doing so
+
+        Args:
+            key -- Cache key
+            compute -- Function that computes, caches and returns the value
+            load -- Function returning the fresh cached value or None
+            stale -- Value served instead of waiting, None waits
+        """
+        with self.__lock__:
+            event = self.__flights__.get(key)
+            leader = event is None
+            if leader:
+                event = self.__flights__[key] = threading.Event()
+        if not leader:
+            if stale is not None:
+                return stale
+            event.wait(self.wait)
+            value = load()
+            if value is not None:
+                return value
+            return compute()
+        try:
+            return self.__lead__(key, compute, load, stale)
+        finally:
+            with self.__lock__:
+                self.__flights__.pop(key, None)
+            event.set()